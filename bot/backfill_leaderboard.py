@@ -0,0 +1,64 @@
+""" Builds the Levels leaderboard sorted sets from the players' xp.
+
+The bot keeps `Levels.{server_id}:leaderboard` up to date whenever it awards
+xp, this only needs to be run once for the players that got their xp before
+the leaderboard existed. It is safe to run while the bot is up: scores are
+only ever raised (ZADD GT) so a stale read can't undo a fresh award.
+
+    REDIS_URL=redis://localhost/ python backfill_leaderboard.py
+"""
+import os
+import logging
+import redis
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('discord')
+
+BATCH_SIZE = 1000
+
+
+def backfill_server(db, server_prefix):
+    players_key = server_prefix + 'players'
+    leaderboard_key = server_prefix + 'leaderboard'
+    total = 0
+    batch = []
+    for player_id in db.sscan_iter(players_key, count=BATCH_SIZE):
+        batch.append(player_id)
+        if len(batch) >= BATCH_SIZE:
+            total += backfill_players(db, server_prefix, leaderboard_key,
+                                      batch)
+            batch = []
+    if batch:
+        total += backfill_players(db, server_prefix, leaderboard_key, batch)
+    return total
+
+
+def backfill_players(db, server_prefix, leaderboard_key, player_ids):
+    # Players that migrate_players.py didn't get to yet still have their
+    # xp in a string key
+    pipe = db.pipeline(transaction=False)
+    for player_id in player_ids:
+        player_key = '{}player:{}'.format(server_prefix, player_id)
+        pipe.hget(player_key, 'xp')
+        pipe.get(player_key + ':xp')
+    values = pipe.execute()
+    scores = {}
+    for i, player_id in enumerate(player_ids):
+        xp, legacy_xp = values[2*i:2*i+2]
+        if xp is not None or legacy_xp is not None:
+            scores[player_id] = int(xp or 0) + int(legacy_xp or 0)
+    if scores:
+        db.zadd(leaderboard_key, scores, gt=True)
+    return len(scores)
+
+
+def main():
+    db = redis.Redis.from_url(os.getenv('REDIS_URL'), decode_responses=True)
+    for players_key in db.scan_iter(match='Levels.*:players', count=1000):
+        server_prefix = players_key[:-len('players')]
+        count = backfill_server(db, server_prefix)
+        log.info('{}leaderboard: {} players'.format(server_prefix, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+""" Replays synthetic traffic through RickBot.dispatch and the plugins,
+without connecting to Discord.
+
+Fake servers, channels, members and messages are fed to dispatch() as if
+they came from the gateway, send_message() only records the replies. Redis
+is real: point REDIS_URL at a local, disposable instance (--flush empties
+the selected db first).
+
+    REDIS_URL=redis://localhost/15 python bench_dispatch.py --servers 200 \\
+        --players 500 --messages 50000 --command-ratio 0.05
+
+It reports messages/sec, the p50/p99 latency of the plugin handlers and
+how many Redis commands each message cost (from INFO commandstats).
+"""
+import os
+import random
+import asyncio
+import logging
+import argparse
+from time import perf_counter
+from itertools import accumulate
+
+import discord
+from rickbot import RickBot
+from scheduler import OVERFLOW_POLICIES
+
+log = logging.getLogger('discord')
+
+
+class FakeMember(object):
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.discriminator = '{:04d}'.format(int(id) % 10000)
+        self.avatar = None
+        self.mention = '<@{}>'.format(id)
+        self.status = discord.Status.online
+
+
+class FakeServer(object):
+
+    def __init__(self, id, players):
+        self.id = id
+        self.name = 'Server {}'.format(id)
+        self.icon = None
+        self.members = [FakeMember(str(int(id) * 100000 + i),
+                                   'Player {}'.format(i))
+                        for i in range(players)]
+        self.owner = self.members[0]
+        self.channel = FakeChannel(id, self)
+
+
+class FakeChannel(object):
+
+    def __init__(self, id, server):
+        self.id = id
+        self.server = server
+
+
+class FakeMessage(object):
+
+    def __init__(self, content, author, channel):
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.server = channel.server
+
+
+class BenchBot(RickBot):
+    """ A RickBot that never talks to Discord and times its plugins """
+
+    user = FakeMember('1', 'RickBot')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.latencies = []
+
+    async def send_message(self, destination, content, *args, **kwargs):
+        self.sent += 1
+
+    async def on_error(self, event_method, *args, **kwargs):
+        self.errors += 1
+        if self.errors == 1:
+            log.exception('First error in {}'.format(event_method))
+
+    async def _run_plugin_event(self, handler, *args, **kwargs):
+        self.in_flight += 1
+        start = perf_counter()
+        try:
+            return await super()._run_plugin_event(handler, *args, **kwargs)
+        finally:
+            self.latencies.append(perf_counter() - start)
+            self.in_flight -= 1
+
+
+def make_traffic(servers, count, command_ratio, skew, commands):
+    """ `count` messages over `servers`. Speakers follow a Zipf-like
+    distribution of exponent `skew`, so a few players do most of the
+    talking, like on real servers. """
+    weights = list(accumulate(1 / (rank ** skew)
+                              for rank in range(1, len(servers[0].members) + 1)))
+    server_weights = list(accumulate(1 / (rank ** skew)
+                                     for rank in range(1, len(servers) + 1)))
+    messages = []
+    for _ in range(count):
+        server = random.choices(servers, cum_weights=server_weights)[0]
+        author = random.choices(server.members, cum_weights=weights)[0]
+        if random.random() < command_ratio:
+            content = random.choice(commands)
+        else:
+            content = 'just chatting about stuff {}'.format(random.random())
+        messages.append(FakeMessage(content, author, server.channel))
+    return messages
+
+
+async def setup_servers(bot, servers, custom_commands):
+    pipe = bot.db.redis.pipeline(transaction=False)
+    for server in servers:
+        pipe.sadd('servers', server.id)
+        pipe.sadd('plugins:{}'.format(server.id), 'Commands', 'Help', 'Levels')
+        pipe.set('Levels.{}:announcement_enabled'.format(server.id), '1')
+        pipe.set('Levels.{}:announcement'.format(server.id),
+                 '{player} reached level {level}')
+        for name in custom_commands:
+            pipe.sadd('Commands.{}:commands'.format(server.id), name)
+            pipe.set('Commands.{}:command:{}'.format(server.id, name),
+                     'Response to {}'.format(name))
+    await pipe.execute()
+
+
+async def redis_calls(bot):
+    stats = await bot.db.redis.info('commandstats')
+    return sum(stat['calls'] for stat in stats.values())
+
+
+async def replay(bot, messages, batch):
+    start = perf_counter()
+    for i, message in enumerate(messages):
+        bot.dispatch('message', message)
+        if i % batch == batch - 1:
+            await asyncio.sleep(0)
+    # Wait for the handlers still running, and for the routing tasks
+    # that haven't started them yet
+    while True:
+        await asyncio.sleep(0)
+        current = asyncio.Task.current_task(bot.loop)
+        pending = [t for t in asyncio.Task.all_tasks(bot.loop)
+                   if not t.done() and t is not current]
+        if bot.in_flight == 0 and not bot.scheduler.queued and not pending:
+            break
+        await asyncio.sleep(0.001)
+    return perf_counter() - start
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+async def main(args):
+    bot = BenchBot(redis_url=os.getenv('REDIS_URL',
+                                       'redis://localhost:6379/15'),
+                   max_concurrency=args.max_concurrency,
+                   max_server_queue=args.max_server_queue,
+                   overflow=args.overflow)
+    if args.flush:
+        await bot.db.redis.flushdb()
+    for plugin in bot.plugins:
+        if hasattr(plugin, 'cooldown'):
+            plugin.cooldown = args.cooldown
+
+    custom_commands = ['!cmd{}'.format(i) for i in range(args.custom_commands)]
+    servers = [FakeServer(str(900000 + i), args.players)
+               for i in range(args.servers)]
+    await setup_servers(bot, servers, custom_commands)
+    commands = ['!help', '!xp', '!levels'] + custom_commands
+    messages = make_traffic(servers, args.messages, args.command_ratio,
+                            args.skew, commands)
+
+    calls_before = await redis_calls(bot)
+    elapsed = await replay(bot, messages, args.batch)
+    # The stats buffered by dispatch are part of what a message costs
+    await bot.stats.flush()
+    # INFO itself is one more call
+    calls = await redis_calls(bot) - calls_before - 1
+
+    print('messages        {}'.format(len(messages)))
+    print('servers         {}'.format(len(servers)))
+    print('elapsed         {:.2f}s'.format(elapsed))
+    print('messages/sec    {:.0f}'.format(len(messages) / elapsed))
+    print('handler p50     {:.3f}ms'.format(
+        1000 * percentile(bot.latencies, 50)))
+    print('handler p99     {:.3f}ms'.format(
+        1000 * percentile(bot.latencies, 99)))
+    print('redis cmds/msg  {:.2f}'.format(calls / len(messages)))
+    print('replies sent    {}'.format(bot.sent))
+    print('handler errors  {}'.format(bot.errors))
+    print('shed overflow   {}'.format(bot.scheduler.shed['overflow']))
+    print('shed coalesced  {}'.format(bot.scheduler.shed['coalesced']))
+    await bot.db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--servers', type=int, default=100)
+    parser.add_argument('--players', type=int, default=200,
+                        help='members per server')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--command-ratio', type=float, default=0.05,
+                        help='share of messages that are commands')
+    parser.add_argument('--custom-commands', type=int, default=20,
+                        help='custom commands per server')
+    parser.add_argument('--skew', type=float, default=1.1,
+                        help='Zipf exponent of who talks, and where')
+    parser.add_argument('--cooldown', type=int, default=60,
+                        help='Levels xp cooldown in seconds, at least 1')
+    parser.add_argument('--batch', type=int, default=100,
+                        help='messages dispatched between two loop yields')
+    parser.add_argument('--max-concurrency', type=int, default=100,
+                        help='plugin handlers running at once')
+    parser.add_argument('--max-server-queue', type=int, default=1000,
+                        help='plugin handlers queued per server')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES,
+                        default='coalesce')
+    parser.add_argument('--flush', action='store_true',
+                        help='FLUSHDB the Redis db first')
+    args = parser.parse_args()
+
+    random.seed(0)
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(args))
@@ -1,4 +1,6 @@
 from rickbot import RickBot
+from database import make_pool
+import asyncio
 import os
 import logging
 
@@ -7,9 +9,69 @@ logging.basicConfig(level=logging.INFO)
 token = os.getenv('RICKBOT_TOKEN')
 redis_url = os.getenv('REDIS_URL')
 rickbot_debug = os.getenv('RICKBOT_DEBUG')
+# Seconds between two writes of the buffered stats counters
+stats_interval = float(os.getenv('RICKBOT_STATS_INTERVAL', 10))
+# Sharding: RICKBOT_SHARD_COUNT shards in total, of which this process runs
+# RICKBOT_SHARD_ID, or the comma separated RICKBOT_SHARD_IDS
+shard_count = os.getenv('RICKBOT_SHARD_COUNT')
+shard_ids = os.getenv('RICKBOT_SHARD_IDS', os.getenv('RICKBOT_SHARD_ID'))
+# Number of event bus streams. When set, the plugins run in worker.py
+# processes instead of the gateway's.
+event_bus_partitions = int(os.getenv('RICKBOT_EVENT_BUS_PARTITIONS', 0))
+# Plugin handlers running at once, queued per server, and what to do with
+# the ones past that: drop_oldest or coalesce
+max_concurrency = int(os.getenv('RICKBOT_MAX_CONCURRENCY', 100))
+max_server_queue = int(os.getenv('RICKBOT_MAX_SERVER_QUEUE', 1000))
+overflow = os.getenv('RICKBOT_OVERFLOW', 'coalesce')
+# Sends the messages straight to this REST API, e.g. a local fake Discord
+api_base = os.getenv('RICKBOT_API_BASE')
+# Keep the xp cooldowns in Redis too, when several processes handle the
+# same servers. Shards never share a server, so they don't need it.
+shared_cooldowns = os.getenv('RICKBOT_SHARED_COOLDOWNS')
+if shared_cooldowns is not None:
+    shared_cooldowns = shared_cooldowns.lower() in ('1', 'true', 'yes')
 
 if rickbot_debug:
     logging.basicConfig(level=logging.DEBUG)
 
-bot = RickBot(redis_url=redis_url)
-bot.run(token)
+
+def make_bot(shard_id=None, shard_count=None, loop=None, redis_pool=None):
+    return RickBot(redis_url=redis_url, stats_interval=stats_interval,
+                   shard_id=shard_id, shard_count=shard_count, loop=loop,
+                   redis_pool=redis_pool,
+                   event_bus_partitions=event_bus_partitions,
+                   max_concurrency=max_concurrency,
+                   max_server_queue=max_server_queue, overflow=overflow,
+                   api_base=api_base, shared_cooldowns=shared_cooldowns)
+
+
+def run_shards(shard_ids, shard_count):
+    """ Runs several shards on the same event loop, and Redis pool """
+    loop = asyncio.get_event_loop()
+    pool = make_pool(redis_url)
+    bots = [make_bot(shard_id, shard_count, loop, pool)
+            for shard_id in shard_ids]
+    try:
+        loop.run_until_complete(asyncio.gather(
+            *[bot.start(token) for bot in bots]))
+    except KeyboardInterrupt:
+        loop.run_until_complete(asyncio.gather(
+            *[bot.shutdown() for bot in bots]))
+        loop.run_until_complete(pool.disconnect())
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    if shard_count is None:
+        make_bot().run(token)
+    else:
+        shard_count = int(shard_count)
+        if shard_ids is None:
+            shard_ids = range(shard_count)
+        else:
+            shard_ids = [int(shard_id) for shard_id in shard_ids.split(',')]
+        if len(shard_ids) == 1:
+            make_bot(shard_ids[0], shard_count).run(token)
+        else:
+            run_shards(shard_ids, shard_count)
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from math import ceil, floor
+from time import monotonic
+
+
+class CooldownTable(object):
+    """ Who is on cooldown, in memory.
+
+    Keys are filed by the `resolution` seconds slot their cooldown ends in.
+    A key maps to its slot, and each slot holds the set of keys ending in
+    it, oldest slot first. Checking a key is a dict lookup, and expired
+    slots are thrown away whole as time goes. A cooldown can last up to
+    `resolution` seconds longer than asked.
+    """
+
+    def __init__(self, resolution=1, clock=monotonic):
+        self.resolution = resolution
+        self.clock = clock
+        # key -> slot its cooldown ends in
+        self.ends = {}
+        # slot -> keys ending in it, in slot order
+        self.slots = OrderedDict()
+
+    def __len__(self):
+        return len(self.ends)
+
+    def _slot(self, seconds):
+        """ The slot a cooldown ending at `seconds` goes in """
+        return int(ceil(seconds / self.resolution))
+
+    def _current(self, now):
+        """ The last slot that ended by `now` """
+        return int(floor(now / self.resolution))
+
+    def prune(self, now=None):
+        current = self._current(self.clock() if now is None else now)
+        while self.slots:
+            slot, keys = next(iter(self.slots.items()))
+            if slot > current:
+                break
+            del self.slots[slot]
+            for key in keys:
+                # Unless it started a new cooldown since
+                if self.ends.get(key) == slot:
+                    del self.ends[key]
+
+    def on_cooldown(self, key, now=None):
+        now = self.clock() if now is None else now
+        return self.ends.get(key, 0) > self._current(now)
+
+    def acquire(self, key, duration):
+        """ Starts a `duration` seconds cooldown for `key` unless it is
+        already on one. Returns whether it started one. """
+        now = self.clock()
+        self.prune(now)
+        if self.on_cooldown(key, now):
+            return False
+        slot = self._slot(now + duration)
+        self.ends[key] = slot
+        keys = self.slots.get(slot)
+        if keys is None:
+            keys = self.slots[slot] = set()
+        keys.add(key)
+        return True
+
+    def release(self, key):
+        """ Ends `key`'s cooldown early """
+        slot = self.ends.pop(key, None)
+        keys = self.slots.get(slot)
+        if keys is not None:
+            keys.discard(key)
@@ -1,25 +1,51 @@
-import redis
 import asyncio
 import logging
+from redis.asyncio import BlockingConnectionPool
 from storage import Storage
+from lru import LRUCache
 
 log = logging.getLogger('discord')
 
+def make_pool(redis_url, max_connections=50):
+    # When every connection is busy callers wait for a free one instead of
+    # opening more sockets.
+    return BlockingConnectionPool.from_url(
+        redis_url,
+        decode_responses=True,
+        max_connections=max_connections
+    )
+
 class Db(object):
 
-    def __init__(self, redis_url):
+    def __init__(self, redis_url, max_connections=50, max_storages=10000,
+                 metrics=None, pool=None):
         self.redis_url = redis_url
-        self.redis = redis.Redis.from_url(redis_url, decode_responses=True)
+        self.metrics = metrics
+        # One pool for the whole process, the shards running in the same
+        # process are all given the same one. Whoever made it closes it.
+        self.owns_pool = pool is None
+        if pool is None:
+            pool = make_pool(redis_url, max_connections)
+        self.pool = pool
+        # Not namespaced, but instrumented like the plugins' storages
+        self.redis = Storage(connection_pool=self.pool, namespace='',
+                             metrics=metrics)
+        # Namespaced views over the pool, one per (plugin, server)
+        self.storages = LRUCache(max_storages)
 
     def get_storage(self, plugin, server):
-        namespace = "{}.{}:".format(
-            plugin.__class__.__name__,
-            server.id
-        )
-        storage = Storage.from_url(
-            self.redis_url,
-            decode_responses=True,
-            namespace=namespace
-        )
+        key = (plugin.__class__.__name__, server.id)
+        storage = self.storages.get(key)
+        if storage is not None:
+            return storage
+
+        namespace = "{}.{}:".format(*key)
+        storage = Storage(connection_pool=self.pool, namespace=namespace,
+                          metrics=self.metrics)
+        self.storages.set(key, storage)
 
         return storage
+
+    async def close(self):
+        if self.owns_pool:
+            await self.pool.disconnect()
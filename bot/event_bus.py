@@ -0,0 +1,274 @@
+""" Plugin events over Redis Streams
+
+The gateway serializes the plugin events into one of `partitions` streams,
+picked by server, and the workers (see worker.py) run the plugins on them
+through a consumer group. Entries that keep failing end up in the dead
+letter stream.
+"""
+import asyncio
+import json
+import logging
+from datetime import datetime
+from time import time
+
+import discord
+from redis.exceptions import ResponseError
+
+log = logging.getLogger('discord')
+
+STREAM = 'rickbot:events:{}'
+DEAD_LETTER_STREAM = 'rickbot:events:dead'
+GROUP = 'plugins'
+
+# How datetimes go over the bus. The library's are naive UTC ones.
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# What the plugins get to see of the discord models. Member comes before
+# User as it subclasses it.
+SNAPSHOT_ATTRS = {
+    'Message': ('id', 'content', 'author', 'channel', 'server', 'timestamp',
+                'edited_timestamp', 'tts', 'mention_everyone', 'mentions',
+                'channel_mentions', 'role_mentions', 'attachments',
+                'embeds'),
+    'Member': ('id', 'name', 'discriminator', 'avatar', 'bot', 'nick',
+               'status', 'joined_at', 'roles', 'server'),
+    'User': ('id', 'name', 'discriminator', 'avatar', 'bot'),
+    'Channel': ('id', 'name', 'server', 'topic', 'is_private', 'position',
+                'type'),
+    'PrivateChannel': ('id', 'user', 'is_private'),
+    'Server': ('id', 'name', 'icon', 'region', 'owner_id'),
+    'Role': ('id', 'name', 'position'),
+}
+
+
+class Snapshot(discord.Object):
+    """ A read-only copy of a discord model, as sent over the event bus.
+
+    It is a discord.Object so it can be given to send_message and friends.
+    """
+
+    def __init__(self, kind, attrs):
+        self.kind = kind
+        self.__dict__.update(attrs)
+
+    @property
+    def mention(self):
+        if self.kind == 'Channel':
+            return '<#{}>'.format(self.id)
+        if self.kind == 'Role':
+            return '<@&{}>'.format(self.id)
+        return '<@{}>'.format(self.id)
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return '<Snapshot {} id={}>'.format(self.kind, self.id)
+
+
+def encode(value):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if isinstance(value, dict):
+        return {str(k): encode(v) for k, v in value.items()}
+    if isinstance(value, datetime):
+        return {'__datetime__': value.strftime(DATETIME_FORMAT)}
+    if isinstance(value, Snapshot):
+        attrs = {k: encode(v) for k, v in value.__dict__.items()
+                 if k != 'kind'}
+        return {'__kind__': value.kind, 'attrs': attrs}
+    for cls in type(value).__mro__:
+        attrs = SNAPSHOT_ATTRS.get(cls.__name__)
+        if attrs is not None:
+            return {'__kind__': cls.__name__,
+                    'attrs': {attr: encode(getattr(value, attr, None))
+                              for attr in attrs}}
+    # Enums and the like
+    return str(value)
+
+
+def decode(value):
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if isinstance(value, dict):
+        if '__datetime__' in value:
+            return datetime.strptime(value['__datetime__'],
+                                     DATETIME_FORMAT)
+        if '__kind__' in value:
+            return Snapshot(value['__kind__'],
+                            {k: decode(v) for k, v in value['attrs'].items()})
+        return {k: decode(v) for k, v in value.items()}
+    return value
+
+
+def encode_event(args, kwargs):
+    return json.dumps({'args': encode(args), 'kwargs': encode(kwargs)})
+
+
+def decode_event(payload):
+    data = json.loads(payload)
+    return decode(data['args']), decode(data['kwargs'])
+
+
+class EventBus(object):
+
+    def __init__(self, redis, partitions=16, maxlen=100000, max_attempts=3,
+                 max_deliveries=5, loop=None):
+        self.redis = redis
+        self.partitions = partitions
+        # Approximate cap of each stream, the oldest entries go first
+        self.maxlen = maxlen
+        # Runs of the failing handlers of an event before dead-lettering it
+        self.max_attempts = max_attempts
+        # Deliveries of an entry never acked, i.e. whose worker died
+        self.max_deliveries = max_deliveries
+        self.loop = loop
+        self.pending = []
+        self.flushing = None
+        self.published = 0
+        self.publish_errors = 0
+
+    def stream(self, partition):
+        return STREAM.format(partition)
+
+    def partition(self, server_id):
+        return int(server_id) % self.partitions
+
+    # Gateway side
+
+    def publish(self, server, event, args, kwargs):
+        """ Queues an event, everything published during the same loop
+        iteration is sent in a single pipeline """
+        fields = {
+            'event': event,
+            'server': server.id,
+            'payload': encode_event(args, kwargs)
+        }
+        self.pending.append((self.stream(self.partition(server.id)), fields))
+        if self.flushing is None:
+            self.flushing = discord.utils.create_task(self.flush(),
+                                                      loop=self.loop)
+
+    async def flush(self):
+        try:
+            while self.pending:
+                pending, self.pending = self.pending, []
+                pipe = self.redis.pipeline(transaction=False)
+                for stream, fields in pending:
+                    pipe.xadd(stream, fields, maxlen=self.maxlen,
+                              approximate=True)
+                try:
+                    await pipe.execute()
+                    self.published += len(pending)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # The gateway can't hold on to them, they're lost
+                    self.publish_errors += len(pending)
+                    log.exception('Could not publish {} events'.format(
+                        len(pending)))
+        finally:
+            self.flushing = None
+
+    # Worker side
+
+    async def create_groups(self, partitions):
+        for partition in partitions:
+            try:
+                await self.redis.xgroup_create(self.stream(partition), GROUP,
+                                               id='0', mkstream=True)
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    async def read(self, consumer, partitions, count=100, block=1000):
+        """ New entries for `consumer`, as (stream, entry id, fields) """
+        streams = {self.stream(partition): '>' for partition in partitions}
+        response = await self.redis.xreadgroup(GROUP, consumer, streams,
+                                               count=count, block=block)
+        return [(stream, entry_id, fields)
+                for stream, entries in response or ()
+                for entry_id, fields in entries]
+
+    async def ack(self, stream, entry_id):
+        await self.redis.xack(stream, GROUP, entry_id)
+
+    async def retry(self, stream, entry_id, fields, plugins):
+        """ Puts the event back for the `plugins` whose handlers failed, or
+        dead-letters it once it ran out of attempts """
+        attempt = int(fields.get('attempt', 0)) + 1
+        if attempt >= self.max_attempts:
+            await self.dead_letter(stream, entry_id, fields,
+                                   'failed: ' + ','.join(plugins))
+            return
+        retried = dict(fields)
+        retried['attempt'] = attempt
+        retried['plugins'] = ','.join(plugins)
+        # Back off a bit before the next attempt
+        retried['not_before'] = time() + 2 ** attempt
+        pipe = self.redis.pipeline()
+        pipe.xadd(stream, retried, maxlen=self.maxlen, approximate=True)
+        pipe.xack(stream, GROUP, entry_id)
+        await pipe.execute()
+
+    async def dead_letter(self, stream, entry_id, fields, reason):
+        log.warning('Dead-lettering {} {} ({})'.format(stream, entry_id,
+                                                       reason))
+        dead = dict(fields)
+        dead['stream'] = stream
+        dead['entry_id'] = entry_id
+        dead['reason'] = reason
+        pipe = self.redis.pipeline()
+        pipe.xadd(DEAD_LETTER_STREAM, dead, maxlen=self.maxlen,
+                  approximate=True)
+        pipe.xack(stream, GROUP, entry_id)
+        await pipe.execute()
+
+    async def claim_stale(self, consumer, partitions, min_idle, count=100):
+        """ Takes over the entries delivered more than `min_idle` seconds
+        ago and never acked, their worker probably died. The ones delivered
+        too many times are dead-lettered instead. """
+        min_idle_ms = int(min_idle * 1000)
+        claimed = []
+        for partition in partitions:
+            stream = self.stream(partition)
+            pending = await self.redis.xpending_range(
+                stream, GROUP, min='-', max='+', count=count, idle=min_idle_ms)
+            retry_ids = []
+            for entry in pending:
+                if entry['times_delivered'] < self.max_deliveries:
+                    retry_ids.append(entry['message_id'])
+                    continue
+                entries = await self.redis.xrange(stream, entry['message_id'],
+                                                  entry['message_id'])
+                fields = entries[0][1] if entries else {}
+                await self.dead_letter(stream, entry['message_id'], fields,
+                                       'delivered {} times'.format(
+                                           entry['times_delivered']))
+            if retry_ids:
+                entries = await self.redis.xclaim(stream, GROUP, consumer,
+                                                  min_idle_ms, retry_ids)
+                claimed.extend((stream, entry_id, fields)
+                               for entry_id, fields in entries if fields)
+        return claimed
+
+    async def lag(self, partitions):
+        """ partition -> (entries not read yet, entries read but not acked) """
+        lag = {}
+        for partition in partitions:
+            stream = self.stream(partition)
+            for group in await self.redis.xinfo_groups(stream):
+                if group['name'] != GROUP:
+                    continue
+                behind = group.get('lag')
+                if behind is None:
+                    # Redis < 7 doesn't know, the stream length is an
+                    # upper bound
+                    behind = await self.redis.xlen(stream)
+                lag[partition] = (behind, group['pending'])
+        return lag
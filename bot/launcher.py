@@ -0,0 +1,74 @@
+""" Runs every shard of the bot on this host, one process per core
+
+    RICKBOT_SHARD_COUNT shards in total (default: one per core), split over
+    RICKBOT_PROCESSES processes (default: one per core). Dead processes
+    are restarted.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+log = logging.getLogger('discord')
+
+
+def run_process(shard_ids, shard_count):
+    # Imported here so every process builds its own bot and event loop
+    import bot
+    if len(shard_ids) == 1:
+        bot.make_bot(shard_ids[0], shard_count).run(bot.token)
+    else:
+        bot.run_shards(shard_ids, shard_count)
+
+
+def split_shards(shard_count, processes):
+    """ Spreads the shards evenly, round-robin, over the processes """
+    return [list(range(i, shard_count, processes))
+            for i in range(min(processes, shard_count))]
+
+
+def start(name, target, args):
+    process = multiprocessing.Process(target=target, args=args, name=name)
+    process.start()
+    log.info('Started {} in process {}'.format(name, process.pid))
+    return process
+
+
+def supervise(jobs):
+    """ Runs every job, a name -> (target, args) dict, in its own process
+    and restarts the ones that exit until interrupted """
+    running = {name: start(name, target, args)
+               for name, (target, args) in jobs.items()}
+    try:
+        while True:
+            time.sleep(5)
+            for name, process in list(running.items()):
+                if not process.is_alive():
+                    log.warning('{} exited with {}, restarting'.format(
+                        name, process.exitcode))
+                    target, args = jobs[name]
+                    running[name] = start(name, target, args)
+    except KeyboardInterrupt:
+        # The children got the SIGINT too and are shutting down
+        for process in running.values():
+            process.join(30)
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    cores = os.cpu_count() or 1
+    shard_count = int(os.getenv('RICKBOT_SHARD_COUNT', cores))
+    processes = int(os.getenv('RICKBOT_PROCESSES', cores))
+
+    jobs = {}
+    for shard_ids in split_shards(shard_count, processes):
+        name = 'rickbot-shards-{}'.format(','.join(map(str, shard_ids)))
+        jobs[name] = (run_process, (shard_ids, shard_count))
+    supervise(jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+""" The Levels xp curve, shared by the bot and the website.
+
+Completing level n takes BASE_XP * GROWTH**n xp. The cumulative thresholds
+are computed once at import time, every lookup is a bisect over them.
+
+This is the only copy. The website's Docker image COPYs it in (see
+website/Dockerfile), and from a checkout the website imports it from
+../bot.
+"""
+from bisect import bisect_right
+from math import floor
+
+BASE_XP = 100
+GROWTH = 1.2
+# 100*1.2**250 is ~6e21 xp, nobody is getting anywhere near that
+MAX_LEVEL = 250
+
+LEVEL_XP = [BASE_XP * GROWTH**n for n in range(MAX_LEVEL)]
+
+# THRESHOLDS[n] is the total xp needed to reach level n
+THRESHOLDS = [0]
+for _level_xp in LEVEL_XP:
+    THRESHOLDS.append(THRESHOLDS[-1] + _level_xp)
+del _level_xp
+
+
+def level_xp(level):
+    """ xp needed to go from `level` to `level + 1` """
+    return LEVEL_XP[level]
+
+
+def level_threshold(level):
+    """ Total xp needed to reach `level` """
+    return THRESHOLDS[level]
+
+
+def level_from_xp(xp):
+    return min(bisect_right(THRESHOLDS, int(xp)) - 1, MAX_LEVEL - 1)
+
+
+def progress(xp):
+    """ Where a player with `xp` total xp stands in their current level.
+
+    Returns a dict with the level (`lvl`), the xp earned in that level
+    (`xp`), the xp that level takes (`lvl_xp`) and how far along it they are
+    in percent (`xp_percent`).
+    """
+    xp = int(xp)
+    lvl = level_from_xp(xp)
+    remaining_xp = int(xp - THRESHOLDS[lvl])
+    lvl_xp = LEVEL_XP[lvl]
+    return {
+        'lvl': lvl,
+        'xp': remaining_xp,
+        'lvl_xp': int(lvl_xp),
+        'xp_percent': floor(100*remaining_xp/lvl_xp)
+    }
+
+
+def progress_many(xps):
+    """ progress() for a whole leaderboard page at once """
+    return [progress(xp) for xp in xps]
@@ -0,0 +1,89 @@
+from bisect import bisect_left
+from collections import Counter
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # One more for everything above the last bucket (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """ In-process latency histograms, counters and gauges, rendered in the
+    Prometheus text format.
+
+    Labels are given as a tuple of (name, value) pairs so they can be used
+    as dict keys as they are.
+    """
+
+    def __init__(self, labels=()):
+        # Added to every sample, tells the bot processes apart
+        self.labels = tuple(labels)
+        self.histograms = {}
+        self.counters = Counter()
+        self.gauges = {}
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def incr(self, name, labels, amount=1):
+        self.counters[(name, labels)] += amount
+
+    def set(self, name, labels, value):
+        self.gauges[(name, labels)] = value
+
+    def _format_labels(self, labels):
+        labels = self.labels + labels
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                              for k, v in labels) + '}'
+
+    def render(self):
+        lines = []
+        typed = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append('# TYPE {} histogram'.format(name))
+                typed.add(name)
+            cumulative = 0
+            bounds = [str(b) for b in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, self._format_labels(labels + (('le', bound),)),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(
+                name, self._format_labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(
+                name, self._format_labels(labels), histogram.count))
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append('# TYPE {} counter'.format(name))
+                typed.add(name)
+            lines.append('{}{} {}'.format(
+                name, self._format_labels(labels), value))
+        for (name, labels), value in sorted(self.gauges.items()):
+            if name not in typed:
+                lines.append('# TYPE {} gauge'.format(name))
+                typed.add(name)
+            lines.append('{}{} {}'.format(
+                name, self._format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,71 @@
+""" Moves Levels players from one string key per field
+(`Levels.{server_id}:player:{player_id}:{field}`) to one hash per player
+(`Levels.{server_id}:player:{player_id}`).
+
+It can run while the bot is up: each player is folded into their hash by
+the same Lua code the bot runs before awarding xp, so a player is migrated
+exactly once whichever gets there first. The SCAN cursor is saved in Redis
+after every batch, running it again resumes where it stopped.
+
+    REDIS_URL=redis://localhost/ python migrate_players.py
+
+Redis keeps a hash in its compact encoding as long as it has at most
+hash-max-listpack-entries fields (128 by default) and no value longer than
+hash-max-listpack-value bytes (64 by default, hash-max-ziplist-* before
+Redis 7). Player hashes have 5 short fields. Only a name over 64 bytes
+makes one fall back to a regular hash table, raise hash-max-listpack-value
+if you have many of those.
+"""
+import os
+import re
+import logging
+import redis
+from plugins.levels import FOLD_LEGACY_PLAYER, LEGACY_FIELDS
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('discord')
+
+CURSOR_KEY = 'Levels:migration:players:cursor'
+BATCH_SIZE = 1000
+
+LEGACY_KEY = re.compile(r'^(Levels\.[^:]+:player:[^:]+):({})$'.format(
+    '|'.join(LEGACY_FIELDS)))
+
+MIGRATE_PLAYER_SCRIPT = FOLD_LEGACY_PLAYER + """
+return fold_legacy_player(KEYS[1], {unpack(KEYS, 2, 6)})
+"""
+
+
+def main():
+    db = redis.Redis.from_url(os.getenv('REDIS_URL'), decode_responses=True)
+    migrate_player = db.register_script(MIGRATE_PLAYER_SCRIPT)
+
+    cursor = int(db.get(CURSOR_KEY) or 0)
+    if cursor:
+        log.info('Resuming from cursor {}'.format(cursor))
+
+    migrated = 0
+    while True:
+        cursor, keys = db.scan(cursor, match='Levels.*:player:*:*',
+                               count=BATCH_SIZE)
+        players = set()
+        for key in keys:
+            match = LEGACY_KEY.match(key)
+            if match:
+                players.add(match.group(1))
+        for player in players:
+            legacy_keys = ['{}:{}'.format(player, field)
+                           for field in LEGACY_FIELDS]
+            if migrate_player(keys=[player] + legacy_keys):
+                migrated += 1
+        db.set(CURSOR_KEY, cursor)
+        log.info('{} players migrated, cursor {}'.format(migrated, cursor))
+        if cursor == 0:
+            break
+
+    db.delete(CURSOR_KEY)
+    log.info('Done')
+
+
+if __name__ == '__main__':
+    main()
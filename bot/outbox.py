@@ -0,0 +1,348 @@
+import asyncio
+import json
+import logging
+from collections import Counter, deque
+from time import monotonic
+
+import aiohttp
+import discord
+
+from lru import LRUCache
+
+log = logging.getLogger('discord')
+
+API_BASE = 'https://discordapp.com/api'
+
+# Lanes, the replies to commands go before the announcements
+REPLY = 0
+ANNOUNCEMENT = 1
+
+# Discord refuses longer messages
+MAX_MESSAGE_LENGTH = 2000
+
+CHANNEL_BUCKET = 'rickbot:ratelimit:channel:{}'
+GLOBAL_BUCKET = 'rickbot:ratelimit:global'
+
+# The channel's and the global token buckets, shared by every process
+# sending as the bot. Takes a token from both, or tells how long to wait
+# for one, or pauses them.
+#
+# KEYS: channel bucket, global bucket
+# ARGV: channel rate, channel per, global rate, global per, pause (s, 0 to
+#       take a token), pause the global bucket too (0/1)
+#
+# Returns the seconds to wait, as a string, '0' when a token was taken.
+TOKEN_BUCKETS_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local function load(key, rate, per)
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated', 'paused')
+    local tokens = tonumber(bucket[1]) or rate
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(rate, tokens + math.max(0, now - updated) * rate / per)
+    return {tokens = tokens, paused = tonumber(bucket[3]) or 0}
+end
+
+local function save(key, bucket, per)
+    redis.call('HSET', key, 'tokens', tostring(bucket.tokens),
+               'updated', tostring(now), 'paused', tostring(bucket.paused))
+    redis.call('EXPIRE', key, math.ceil(per) + 60)
+end
+
+local specs = {{KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2])},
+               {KEYS[2], tonumber(ARGV[3]), tonumber(ARGV[4])}}
+local buckets = {}
+for i, spec in ipairs(specs) do
+    buckets[i] = load(spec[1], spec[2], spec[3])
+end
+
+local pause = tonumber(ARGV[5])
+if pause > 0 then
+    local paused = (ARGV[6] == '1') and 2 or 1
+    for i = 1, paused do
+        buckets[i].tokens = 0
+        buckets[i].paused = math.max(buckets[i].paused, now + pause)
+        save(specs[i][1], buckets[i], specs[i][3])
+    end
+    return '0'
+end
+
+local delay = 0
+for i, bucket in ipairs(buckets) do
+    if bucket.paused > now then
+        delay = math.max(delay, bucket.paused - now)
+    elseif bucket.tokens < 1 then
+        delay = math.max(delay, (1 - bucket.tokens) * specs[i][3] / specs[i][2])
+    end
+end
+if delay == 0 then
+    for i, bucket in ipairs(buckets) do
+        bucket.tokens = bucket.tokens - 1
+        save(specs[i][1], bucket, specs[i][3])
+    end
+end
+return tostring(delay)
+"""
+
+
+class RateLimited(Exception):
+    """ Raised by the senders when Discord answered 429. `is_global` when
+    it's the bot's global limit rather than the channel's. """
+
+    def __init__(self, retry_after, is_global=False):
+        super().__init__('Rate limited for {}s'.format(retry_after))
+        self.retry_after = retry_after
+        self.is_global = is_global
+
+
+class TokenBucket(object):
+    """ `rate` messages every `per` seconds, in bursts of up to `rate` """
+
+    def __init__(self, rate, per, clock=monotonic):
+        self.capacity = rate
+        self.tokens = rate
+        self.fill_rate = rate / per
+        self.clock = clock
+        self.updated = clock()
+        self.paused_until = 0
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+        return now
+
+    def delay(self):
+        """ Seconds until we can take a token """
+        now = self._refill()
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.fill_rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self._refill()
+        self.tokens = 0
+        self.paused_until = self.clock() + seconds
+
+    def sync(self, remaining, reset_after):
+        """ Follows what Discord says is left of its own bucket """
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+        if remaining == 0:
+            self.pause(reset_after)
+
+
+class HttpSender(object):
+    """ Posts the messages with the REST API directly, and reports Discord's
+    rate limit headers back to the outbox. `base_url` can point at a fake
+    endpoint. """
+
+    def __init__(self, token, base_url=API_BASE):
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.session = None
+
+    async def __call__(self, destination, content):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        url = '{}/channels/{}/messages'.format(self.base_url, destination.id)
+        headers = {'authorization': self.token,
+                   'content-type': 'application/json'}
+        data = json.dumps({'content': content})
+        async with self.session.post(url, data=data,
+                                     headers=headers) as response:
+            if response.status == 429:
+                data = await response.json()
+                raise RateLimited(float(data.get('retry_after', 1)),
+                                  bool(data.get('global')))
+            if response.status >= 400:
+                raise discord.HTTPException(response, await response.text())
+            remaining = response.headers.get('X-RateLimit-Remaining')
+            reset_after = response.headers.get('X-RateLimit-Reset-After')
+            if remaining is None or reset_after is None:
+                return None
+            return {'remaining': int(remaining),
+                    'reset_after': float(reset_after)}
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class ChannelQueue(object):
+
+    def __init__(self, destination, bucket):
+        self.destination = destination
+        self.bucket = bucket
+        self.lanes = (deque(), deque())
+        self.task = None
+
+    def __len__(self):
+        return len(self.lanes[REPLY]) + len(self.lanes[ANNOUNCEMENT])
+
+
+class Outbox(object):
+    """ Per channel queues of outgoing messages, paced by token buckets
+    sized like Discord's (5 messages per 5s per channel, 50 per second
+    overall).
+
+    `send(destination, content)` does the actual sending. It may return
+    Discord's rate limit state as {'remaining': ..., 'reset_after': ...}
+    and raises RateLimited on a 429.
+
+    Replies go before announcements. Announcements still queued when their
+    turn comes are merged into a single message.
+
+    The buckets only know about this process. When several processes send
+    as the bot, e.g. shards or event bus workers, give `redis` so they
+    also take their tokens from buckets kept in Redis.
+    """
+
+    def __init__(self, send, rate=5, per=5, global_rate=50, global_per=1,
+                 max_queue=100, max_buckets=10000, redis=None, loop=None,
+                 clock=monotonic):
+        self.send = send
+        self.rate = rate
+        self.per = per
+        self.global_rate = global_rate
+        self.global_per = global_per
+        self.shared_buckets = None
+        if redis is not None:
+            self.shared_buckets = redis.register_script(TOKEN_BUCKETS_SCRIPT)
+        self.max_queue = max_queue
+        self.loop = loop
+        self.clock = clock
+        self.global_bucket = TokenBucket(global_rate, global_per, clock)
+        # channel id -> TokenBucket. They outlive the queues, a channel
+        # whose queue just emptied still has to wait for its tokens.
+        self.buckets = LRUCache(max_buckets)
+        # channel id -> ChannelQueue, for the channels with something queued
+        self.channels = {}
+        self.queued = 0
+        # sent, coalesced, dropped, rate_limited, failed
+        self.counts = Counter()
+
+    def put(self, destination, content, priority=REPLY):
+        queue = self.channels.get(destination.id)
+        if queue is None:
+            bucket = self.buckets.get(destination.id)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.per, self.clock)
+                self.buckets.set(destination.id, bucket)
+            queue = ChannelQueue(destination, bucket)
+            self.channels[destination.id] = queue
+
+        if len(queue) >= self.max_queue:
+            # Announcements go first
+            lane = queue.lanes[ANNOUNCEMENT] or queue.lanes[REPLY]
+            lane.popleft()
+            self.queued -= 1
+            self.counts['dropped'] += 1
+
+        queue.lanes[priority].append(content)
+        self.queued += 1
+        if queue.task is None:
+            queue.task = discord.utils.create_task(self.drain(queue),
+                                                   loop=self.loop)
+
+    def next_message(self, queue):
+        """ (lane, content) of the next message to send """
+        replies, announcements = queue.lanes
+        if replies:
+            self.queued -= 1
+            return REPLY, replies.popleft()
+
+        content = announcements.popleft()
+        self.queued -= 1
+        while announcements and len(content) + 1 + len(announcements[0]) \
+                <= MAX_MESSAGE_LENGTH:
+            content += '\n' + announcements.popleft()
+            self.queued -= 1
+            self.counts['coalesced'] += 1
+        return ANNOUNCEMENT, content
+
+    async def drain(self, queue):
+        try:
+            while len(queue):
+                delay = max(queue.bucket.delay(), self.global_bucket.delay())
+                if delay == 0:
+                    delay = await self.shared_delay(queue.destination.id)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                lane, content = self.next_message(queue)
+                queue.bucket.take()
+                self.global_bucket.take()
+                try:
+                    limits = await self.send(queue.destination, content)
+                except RateLimited as e:
+                    self.counts['rate_limited'] += 1
+                    queue.bucket.pause(e.retry_after)
+                    if e.is_global:
+                        self.global_bucket.pause(e.retry_after)
+                    await self.shared_pause(queue.destination.id,
+                                            e.retry_after, e.is_global)
+                    # Back in front of its lane, as is
+                    queue.lanes[lane].appendleft(content)
+                    self.queued += 1
+                    continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.counts['failed'] += 1
+                    log.exception('Could not send a message to {}'.format(
+                        queue.destination.id))
+                    continue
+                if limits:
+                    queue.bucket.sync(**limits)
+                    if limits['remaining'] == 0:
+                        await self.shared_pause(queue.destination.id,
+                                                limits['reset_after'])
+                self.counts['sent'] += 1
+        finally:
+            queue.task = None
+            if not len(queue):
+                self.channels.pop(queue.destination.id, None)
+
+    async def _shared_buckets(self, channel_id, pause=0, is_global=False):
+        keys = [CHANNEL_BUCKET.format(channel_id), GLOBAL_BUCKET]
+        args = [self.rate, self.per, self.global_rate, self.global_per,
+                pause, int(is_global)]
+        try:
+            return float(await self.shared_buckets(keys=keys, args=args))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Our own buckets still pace this process
+            log.exception('Could not reach the shared rate limits')
+            return 0
+
+    async def shared_delay(self, channel_id):
+        """ Takes a token from the shared buckets, or tells how long to
+        wait for one """
+        if self.shared_buckets is None:
+            return 0
+        return await self._shared_buckets(channel_id)
+
+    async def shared_pause(self, channel_id, seconds, is_global=False):
+        if self.shared_buckets is not None and seconds > 0:
+            await self._shared_buckets(channel_id, seconds, is_global)
+
+    async def flush(self, timeout=10):
+        """ Waits for the queued messages to go out, for a while """
+        tasks = [queue.task for queue in self.channels.values()
+                 if queue.task is not None]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
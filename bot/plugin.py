@@ -14,6 +14,12 @@ class Plugin(object, metaclass=PluginMount):
         self.rickbot = rickbot
         self.db = rickbot.db
 
+    def coalesce_key(self, event, *args, **kwargs):
+        """ Handler runs with the same key are interchangeable, the
+        scheduler may drop all but one of them under load. None if this
+        one must run. """
+        return None
+
     def get_storage(self, server):
         return self.rickbot.db.get_storage(self, server)
 
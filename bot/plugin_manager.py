@@ -4,27 +4,83 @@ from plugin import Plugin
 
 log = logging.getLogger('discord')
 
+PLUGINS_CHANNEL = 'rickbot:invalidate:plugins'
+
+# A list of events that are avalible from the plugins.
+PLUGIN_EVENTS = frozenset((
+    'message',
+    'message_delete',
+    'message_edit',
+    'channel_delete',
+    'channel_create',
+    'channel_update',
+    'member_join',
+    'member_update',
+    'server_update',
+    'server_role_create',
+    'server_role_delete',
+    'server_role_update',
+    'voice_state_update',
+    'member_ban',
+    'member_unban',
+    'typing'
+))
+
 class PluginManager:
 
     def __init__(self, rickbot):
         self.rickbot = rickbot
         self.db = rickbot.db
         self.rickbot.plugins = []
+        # server id -> enabled plugin instances, kept in sync by the
+        # dashboard through the PLUGINS_CHANNEL invalidations
+        self.enabled_plugins = {}
+        self.generation = 0
+        # event -> [(plugin, bound on_<event> method)], filled at load time
+        self.handlers = {}
+        self.rickbot.invalidation_handlers[PLUGINS_CHANNEL] = self.invalidate
 
     def load(self, plugin):
         log.info('Loading plugin {}'.format(plugin.__name__))
         plugin_instance = plugin(self.rickbot)
         self.rickbot.plugins.append(plugin_instance)
+        for event in PLUGIN_EVENTS:
+            handler = getattr(plugin_instance, 'on_' + event, None)
+            if handler is not None:
+                self.handlers.setdefault(event, []).append(
+                    (plugin_instance, handler))
         log.info('Plugin {} loaded'.format(plugin.__name__))
 
     def load_all(self):
         for plugin in Plugin.plugins:
             self.load(plugin)
 
-    def get_all(self, server):
-        plugin_names = self.db.redis.smembers('plugin:{}'.format(server.id))
+    def get_cached(self, server):
+        """ The server's enabled plugins if we already know them, else None """
+        return self.enabled_plugins.get(server.id)
+
+    async def get_all(self, server):
+        plugins = self.enabled_plugins.get(server.id)
+        if plugins is not None:
+            return plugins
+
+        generation = self.generation
+        plugin_names = await self.db.redis.smembers('plugins:{}'.format(server.id))
         plugins = []
         for plugin in self.rickbot.plugins:
             if plugin.__class__.__name__ in plugin_names:
                 plugins.append(plugin)
+        # Don't cache what an invalidation raced with
+        if generation == self.generation:
+            self.enabled_plugins[server.id] = plugins
         return plugins
+
+    def invalidate(self, server_id):
+        """ Forgets a server's enabled plugins, or every server's if
+        `server_id` is None.
+        """
+        self.generation += 1
+        if server_id is None:
+            self.enabled_plugins.clear()
+        else:
+            self.enabled_plugins.pop(server_id, None)
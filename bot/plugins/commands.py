@@ -1,16 +1,71 @@
 from plugin import Plugin
+from lru import LRUCache
 import asyncio
 import logging
 
 log = logging.getLogger('discord')
 
+# The dashboard publishes a server id here when it changes its commands
+COMMANDS_CHANNEL = 'rickbot:invalidate:commands'
+
+
+class CommandIndex(object):
+    """ A server's custom commands, trigger -> response """
+
+    def __init__(self, commands):
+        self.commands = commands
+        # Most messages aren't commands, their first character is enough
+        # to tell
+        self.first_chars = frozenset(name[:1] for name in commands)
+
+    def get(self, content):
+        if content[:1] not in self.first_chars:
+            return None
+        return self.commands.get(content)
+
+
 class Commands(Plugin):
 
     dank_name = 'Custom Commands'
 
-    def get_commands(self, server):
+    def __init__(self, *args, **kwargs):
+        Plugin.__init__(self, *args, **kwargs)
+        # server id -> CommandIndex, loaded on the server's first message
+        self.indexes = LRUCache(5000)
+        self.generation = 0
+        self.rickbot.invalidation_handlers[COMMANDS_CHANNEL] = self.invalidate
+
+    def invalidate(self, server_id):
+        self.generation += 1
+        if server_id is None:
+            self.indexes.clear()
+        else:
+            self.indexes.pop(server_id)
+
+    async def get_index(self, server):
+        index = self.indexes.get(server.id)
+        if index is not None:
+            return index
+
+        generation = self.generation
         storage = self.get_storage(server)
-        commands = sorted(storage.smembers('commands'))
+        names = list(await storage.smembers('commands'))
+        responses = []
+        if names:
+            responses = await storage.mget(
+                *['command:{}'.format(name) for name in names])
+        commands = {name: response
+                    for name, response in zip(names, responses)
+                    if response is not None}
+        index = CommandIndex(commands)
+        # Don't cache what an invalidation raced with
+        if generation == self.generation:
+            self.indexes.set(server.id, index)
+        return index
+
+    async def get_commands(self, server):
+        index = await self.get_index(server)
+        commands = sorted(index.commands)
         cmds = []
         for command in commands:
             cmd = {
@@ -20,16 +75,15 @@ class Commands(Plugin):
         return cmds
 
     async def on_message(self, message):
-        storage = self.get_storage(message.server)
-        commands = storage.smembers('commands')
-        if message.content in commands:
+        index = await self.get_index(message.server)
+        response = index.get(message.content)
+        if response is not None:
             log.info('{}#{}@{} >> {}'.format(
                 message.author.name,
                 message.author.discriminator,
                 message.server.name,
                 message.content
             ))
-            response = storage.get('command:{}'.format(message.content))
             await self.rickbot.send_message(
                 message.channel,
                 response
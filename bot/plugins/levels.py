@@ -1,15 +1,110 @@
 from plugin import Plugin
+from lru import LRUCache
+from outbox import ANNOUNCEMENT
+from cooldown import CooldownTable
+import level_curve
 import logging
 import asyncio
 from random import randint
+from time import time
 
 log = logging.getLogger('discord')
 
+# Each player is one hash, Levels.{server_id}:player:{player_id}, with the
+# xp, lvl, name, discriminator and avatar fields. LEGACY_FIELDS are the
+# string keys (player:{player_id}:{field}) they used to live in.
+LEGACY_FIELDS = ('xp', 'lvl', 'name', 'discriminator', 'avatar')
+
+# Moves a player's legacy keys into their hash. Added xp is summed, the
+# other fields only fill in what the hash doesn't have yet.
+#
+# fold_legacy_player(hash key, {legacy keys in LEGACY_FIELDS order})
+FOLD_LEGACY_PLAYER = """
+local legacy_fields = {'xp', 'lvl', 'name', 'discriminator', 'avatar'}
+local function fold_legacy_player(player, legacy_keys)
+    if redis.call('EXISTS', unpack(legacy_keys)) == 0 then
+        return false
+    end
+    for i, field in ipairs(legacy_fields) do
+        local value = redis.call('GET', legacy_keys[i])
+        if value then
+            if field == 'xp' then
+                redis.call('HINCRBY', player, 'xp', value)
+            else
+                redis.call('HSETNX', player, field, value)
+            end
+        end
+    end
+    redis.call('DEL', unpack(legacy_keys))
+    return true
+end
+"""
+
+# Shared cooldown check, xp increment, level recompute and level change
+# detection in one round trip. Players that still have legacy keys are folded into
+# their hash first.
+#
+# KEYS: check, player, announcement_enabled, announcement, leaderboard,
+#       leaderboard version, legacy keys (LEGACY_FIELDS order)
+# ARGV: xp gain, cooldown (s, 0 when the cooldowns are only kept in
+#       process), base level xp, level xp growth, player id, current unix
+#       time
+#
+# Returns nil while the player is on cooldown, {old_lvl, new_lvl} when the
+# level didn't change and {old_lvl, new_lvl, enabled, announcement} when
+# it did.
+AWARD_XP_SCRIPT = FOLD_LEGACY_PLAYER + """
+if tonumber(ARGV[2]) > 0 and
+        not redis.call('SET', KEYS[1], '1', 'EX', ARGV[2], 'NX') then
+    return nil
+end
+
+fold_legacy_player(KEYS[2], {unpack(KEYS, 7, 11)})
+
+local old_lvl = redis.call('HGET', KEYS[2], 'lvl')
+local xp = redis.call('HINCRBY', KEYS[2], 'xp', ARGV[1])
+redis.call('ZADD', KEYS[5], xp, ARGV[5])
+redis.call('HINCRBY', KEYS[6], 'version', 1)
+redis.call('HSET', KEYS[6], 'modified', ARGV[6])
+
+local base = tonumber(ARGV[3])
+local growth = tonumber(ARGV[4])
+local lvl = 0
+while xp >= base * growth ^ lvl do
+    xp = xp - base * growth ^ lvl
+    lvl = lvl + 1
+end
+
+if old_lvl and tonumber(old_lvl) == lvl then
+    return {lvl, lvl}
+end
+
+redis.call('HSET', KEYS[2], 'lvl', lvl)
+old_lvl = tonumber(old_lvl or 0)
+if old_lvl == lvl then
+    return {old_lvl, lvl}
+end
+return {old_lvl, lvl, redis.call('GET', KEYS[3]), redis.call('GET', KEYS[4])}
+"""
+
 class Levels(Plugin):
 
     dank_name = 'Levels'
 
-    def get_commands(self, server):
+    cooldown = 60
+
+    def __init__(self, *args, **kwargs):
+        Plugin.__init__(self, *args, **kwargs)
+        self.award_xp_script = self.db.redis.register_script(AWARD_XP_SCRIPT)
+        # What we last wrote for each server and player, so unchanged
+        # profiles aren't written again on every message
+        self.profiles = LRUCache(100000)
+        # (server id, player id) on xp cooldown. With several processes
+        # handling the same servers the script checks Redis as well.
+        self.cooldowns = CooldownTable()
+        self.shared_cooldowns = self.rickbot.shared_cooldowns
+
+    async def get_commands(self, server):
         commands = [
             {
                 'name': '!levels',
@@ -22,18 +117,14 @@ class Levels(Plugin):
         ]
         return commands
 
-    @staticmethod
-    def _get_level_xp(n):
-        return 100*(1.2**n)
-
-    @staticmethod
-    def _get_level_from_xp(xp):
-        remaining_xp = int(xp)
-        level = 0
-        while remaining_xp >= Levels._get_level_xp(level):
-            remaining_xp -= Levels._get_level_xp(level)
-            level += 1
-        return level
+    def coalesce_key(self, event, *args, **kwargs):
+        # Any message of a player waiting in line awards the same xp, the
+        # cooldown throws away the others anyway. Not so for the commands.
+        if event == 'message':
+            message = args[0]
+            if message.content not in ('!levels', '!xp'):
+                return ('xp', message.author.id)
+        return None
 
     async def on_message(self, message):
         if message.author.id == self.rickbot.user.id:
@@ -52,8 +143,8 @@ class Levels(Plugin):
         if message.content == '!xp':
             storage = self.get_storage(message.server)
             player = message.author
-            players = storage.smembers('players')
-            if player.id not in players:
+            rank = await storage.zrevrank('leaderboard', player.id)
+            if rank is None:
                 await self.rickbot.send_message(message.channel,
                     "**{}**. It looks like you haven't been ranked yet. Get "\
                     "talking in the chats to get ranked and " \
@@ -63,77 +154,110 @@ class Levels(Plugin):
                 )
                 return
 
-            total_player_xp = storage.get('player:{}:xp'.format(player.id))
-            player_lvl = storage.get('player:{}:lvl'.format(player.id))
-            x = 0
-            for l in range(0,int(player_lvl)):
-                x += 100*(1.2**l)
-            remaining_xp = int(int(player_total_xp) - x)
-            level_xp = int(Levels._get_level_xp(int(player_lvl)))
-            players = self.rickbot.db.redis.sort('Levels.{}:players'.format(message.server.id),
-                        by='Levels.{}:player:*:xp'.format(message.server.id),
-                        start=0,
-                        num=1,
-                        desc=True)
-            player_rank = players.index(player.id)+1
+            player_total_xp = int(await storage.zscore('leaderboard', player.id))
+            player_progress = level_curve.progress(player_total_xp)
+            player_rank = rank+1
+            players_count = await storage.zcard('leaderboard')
 
             response = '{}: **Level {}** | **XP {}/{}** | **Total XP {}** | **Rank {}/{}**'.format(
                 player.mention,
-                player_lvl,
-                remaining_xp,
-                level_xp,
+                player_progress['lvl'],
+                player_progress['xp'],
+                player_progress['lvl_xp'],
                 player_total_xp,
                 player_rank,
-                len(players)
+                players_count
             )
 
             await self.rickbot.send_message(message.channel, response)
             return
 
-        storage = self.get_storage(server)
-
         # Update le player's profile
         player = message.author
         server = message.server
-        self.rickbot.db.redis.set('server:{}:name'.format(server.id), server.name)
-        if server.icon:
-            self.rickbot.db.redis.set('server:{}:icon'.format(server.id), server.icon)
-        if server.icon:
-            storage.sadd('server:icon', server.icon)
-        storage.sadd('players', player.id)
-        storage.set('player:{}:name'.format(player.id), player.name)
-        storage.set('player:{}:discriminator'.format(player.id), player.discriminator)
-        storage.set('player:{}:avatar'.format(player.id), player.avatar)
-
-        # Is the player now ready?
-        check = storage.get('player:{}:check'.format(player.id))
-        if check:
+        storage = self.get_storage(server)
+        await self.update_profiles(storage, server, player)
+
+        # Give player random int xp between 5 and 10 unless they are still
+        # on their 60 sec cooldown
+        cooldown_key = (server.id, player.id)
+        if not self.cooldowns.acquire(cooldown_key, self.cooldown):
+            return
+        try:
+            result = await self.award_xp(storage, player, randint(5,10))
+        except Exception:
+            # No xp given, the next message can try again
+            self.cooldowns.release(cooldown_key)
+            raise
+        if result is None:
             return
 
-        # Get the player's level
-        lvl = storage.get('player:{}:lvl'.format(player.id))
-        if lvl is None:
-            storage.set('player:{}:lvl'.format(player.id), 0)
-            lvl = 0
-        else:
-            lvl = int(lvl)
-
-        # Give player random int xp between 5 and 10
-        storage.incr('player:{}:xp'.format(player.id), amount=randint(5,10))
-        # Block player for a 60 sec cooldown
-        storage.set('player:{}:check'.format(player.id), '1', ex=60)
-        # Get the new player xp
-        player_xp = storage.get('player:{}:xp'.format(player.id))
-        # Update the levels
-        storage.set('player:{}:lvl'.format(player.id), Levels._get_level_from_xp(player_xp))
-        # Now compare the level before and after
-        new_level = int(storage.get('player:{}:lvl'.format(player.id)))
+        lvl, new_level = int(result[0]), int(result[1])
         if new_level != lvl:
-            # Check if the annoucement is ok
-            annoucement_enabled = storage.get('annoucement_enabled')
-            if annoucement_enabled:
-                annoucement = storage.get('annoucement')
-                await self.rickbot.send_message(message.channel, annoucement.format(
+            # Check if the announcement is ok
+            announcement_enabled, announcement = result[2:4]
+            if announcement_enabled and announcement:
+                await self.rickbot.send_message(message.channel, announcement.format(
                     player=player.mention,
                     level=new_level
-                ))
+                ), priority=ANNOUNCEMENT)
+
+    async def update_profiles(self, storage, server, player):
+        """ Writes the server's and the player's profile, only if they
+        changed since we last wrote them """
+        server_profile = (server.name, server.icon)
+        player_profile = (player.name, player.discriminator, player.avatar)
+        server_changed = self.profiles.get(server.id) != server_profile
+        player_key = (server.id, player.id)
+        player_changed = self.profiles.get(player_key) != player_profile
+        if not server_changed and not player_changed:
+            return
+
+        pipe = self.db.redis.pipeline(transaction=False)
+        if server_changed:
+            pipe.set('server:{}:name'.format(server.id), server.name)
+            if server.icon:
+                pipe.set('server:{}:icon'.format(server.id), server.icon)
+                pipe.sadd(storage.namespace + 'server:icon', server.icon)
+        if server_changed or player_changed:
+            # The leaderboard page shows both
+            self.bump_leaderboard_version(pipe, storage)
+        if player_changed:
+            pipe.sadd(storage.namespace + 'players', player.id)
+            pipe.hset(storage.namespace + 'player:{}'.format(player.id),
+                      mapping={
+                          'name': player.name,
+                          'discriminator': player.discriminator,
+                          # levels.html expects the "None" older redis
+                          # clients wrote
+                          'avatar': str(player.avatar)
+                      })
+        await pipe.execute()
+
+        if server_changed:
+            self.profiles.set(server.id, server_profile)
+        if player_changed:
+            self.profiles.set(player_key, player_profile)
+
+    def bump_leaderboard_version(self, pipe, storage):
+        """ Tells the website its cached leaderboard page is stale """
+        key = storage.namespace + 'leaderboard:version'
+        pipe.hincrby(key, 'version', 1)
+        pipe.hset(key, 'modified', int(time()))
+
+    async def award_xp(self, storage, player, xp):
+        keys = [
+            'player:{}:check'.format(player.id),
+            'player:{}'.format(player.id),
+            'announcement_enabled',
+            'announcement',
+            'leaderboard',
+            'leaderboard:version'
+        ]
+        keys += ['player:{}:{}'.format(player.id, field)
+                 for field in LEGACY_FIELDS]
+        keys = [storage.namespace + key for key in keys]
+        cooldown = self.cooldown if self.shared_cooldowns else 0
+        args = [xp, cooldown, level_curve.BASE_XP, level_curve.GROWTH,
+                player.id, int(time())]
+        return await self.award_xp_script(keys=keys, args=args)
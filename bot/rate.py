@@ -0,0 +1,82 @@
+from array import array
+from time import monotonic
+
+
+class RateCounter(object):
+    """ Counts events over a sliding window with fixed memory.
+
+    The window is cut in one second buckets kept in a ring, a bucket is
+    zeroed when the ring comes back around to it. Adding an event is O(1)
+    however many happen, counting sums at most `window` buckets.
+    """
+
+    def __init__(self, window=300, clock=monotonic):
+        self.window = window
+        self.clock = clock
+        self.buckets = array('L', [0]) * window
+        self.tick = int(clock())
+
+    def _advance(self):
+        tick = int(self.clock())
+        elapsed = tick - self.tick
+        if elapsed <= 0:
+            return tick
+        if elapsed >= self.window:
+            for i in range(self.window):
+                self.buckets[i] = 0
+        else:
+            for t in range(self.tick + 1, tick + 1):
+                self.buckets[t % self.window] = 0
+        self.tick = tick
+        return tick
+
+    def add(self, count=1):
+        tick = self._advance()
+        self.buckets[tick % self.window] += count
+
+    def count(self, seconds):
+        """ Number of events in the last `seconds` seconds (including the
+        current, partial, one) """
+        tick = self._advance()
+        seconds = min(seconds, self.window)
+        return sum(self.buckets[(tick - i) % self.window]
+                   for i in range(seconds))
+
+
+class MessageRates(object):
+    """ Messages per 1s/60s/5m, globally and for each server """
+
+    windows = (1, 60, 300)
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.total = RateCounter(max(self.windows), clock)
+        self.servers = {}
+
+    def add(self, server_id=None):
+        self.total.add()
+        if server_id is None:
+            return
+        counter = self.servers.get(server_id)
+        if counter is None:
+            counter = RateCounter(max(self.windows), self.clock)
+            self.servers[server_id] = counter
+        counter.add()
+
+    def rates(self, server_id=None):
+        """ {window: count} for a server, or for everything when
+        `server_id` is None """
+        if server_id is None:
+            counter = self.total
+        else:
+            counter = self.servers.get(server_id)
+            if counter is None:
+                return {window: 0 for window in self.windows}
+        return {window: counter.count(window) for window in self.windows}
+
+    def prune(self):
+        """ Forgets the servers that were quiet for the whole window """
+        quiet = [server_id for server_id, counter in self.servers.items()
+                 if counter.count(counter.window) == 0]
+        for server_id in quiet:
+            del self.servers[server_id]
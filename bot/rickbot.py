@@ -1,10 +1,19 @@
 import discord
 import asyncio
 import logging
-from plugin_manager import PluginManager
+import os
+import socket
+from time import perf_counter, time
+from plugin_manager import PluginManager, PLUGIN_EVENTS
 from database import Db
 from utils import find_server
-from time import time
+from rate import MessageRates
+from stats import StatsCounters, MemberCounters
+from metrics import Metrics
+from event_bus import EventBus
+from scheduler import Scheduler
+from outbox import Outbox, HttpSender, RateLimited, REPLY
+from collections import Counter
 
 from plugins.commands import Commands
 from plugins.help import Help
@@ -12,109 +21,389 @@ from plugins.levels import Levels
 
 log = logging.getLogger('discord')
 
+# Sums the per-shard stats into the global rickbot:stats:* keys and merges
+# the per-shard server hashes. Shards that stopped reporting have their keys
+# expired and simply don't count anymore.
+#
+# KEYS: for each gauge, then each hash, its rickbot:stats:* key followed by
+#       its key of every shard
+# ARGV: shard count, number of gauges
+AGGREGATE_STATS_SCRIPT = """
+local count = tonumber(ARGV[1])
+local gauges = tonumber(ARGV[2])
+local stat = 0
+for i = 1, #KEYS, count + 1 do
+    stat = stat + 1
+    local dst = KEYS[i]
+    if stat <= gauges then
+        local total = 0
+        for shard = 1, count do
+            total = total + (tonumber(redis.call('GET', KEYS[i + shard])) or 0)
+        end
+        redis.call('SET', dst, total)
+    else
+        redis.call('DEL', dst)
+        for shard = 1, count do
+            local fields = redis.call('HGETALL', KEYS[i + shard])
+            if #fields > 0 then
+                redis.call('HSET', dst, unpack(fields))
+            end
+        end
+    end
+end
+"""
+
 
 class RickBot(discord.Client):
     def __init__(self, *args, **kwargs):
-        self.redis_url = kwargs.get('redis_url')
-        self.db = Db(self.redis_url)
+        self.redis_url = kwargs.pop('redis_url')
+        # The Redis pool, when shared with other bots of the process
+        redis_pool = kwargs.pop('redis_pool', None)
+        self.stats_interval = kwargs.pop('stats_interval', 10)
+        # When set, plugin events go to the workers through the event bus
+        # instead of running here
+        event_bus_partitions = kwargs.pop('event_bus_partitions', None)
+        # Plugin handlers running at once, handlers queued per server and
+        # what to shed past that, see Scheduler
+        max_concurrency = kwargs.pop('max_concurrency', 100)
+        max_server_queue = kwargs.pop('max_server_queue', 1000)
+        overflow = kwargs.pop('overflow', 'coalesce')
+        # Whether the plugins' cooldowns are also kept in Redis, for when
+        # several processes handle the same servers
+        self.shared_cooldowns = bool(kwargs.pop('shared_cooldowns', False))
+        # Posts the messages to this REST API instead of going through the
+        # library, e.g. to a fake Discord
+        self.api_base = kwargs.pop('api_base', None)
+        super().__init__(*args, **kwargs)
+        # An unsharded bot is the only shard of one
+        self.shard = self.shard_id or 0
+        self.shards = self.shard_count or 1
+        self.process_name = '{}:{}'.format(socket.gethostname(), os.getpid())
+        if self.shard_count:
+            self.process_name += ':{}'.format(self.shard)
+        self.metrics = Metrics(labels=(('process', self.process_name),))
+        self.db = Db(self.redis_url, metrics=self.metrics, pool=redis_pool)
+        # pub/sub channel -> callback(server_id) dropping cached state
+        self.invalidation_handlers = {}
         self.plugin_manager = PluginManager(self)
         self.plugin_manager.load_all()
-        self.last_messages = []
+        self.message_rates = MessageRates()
+        self.stats = StatsCounters(self.db)
+        self.member_counters = MemberCounters()
+        # Plugin events that reached at least one handler / that didn't
+        self.dispatched_events = Counter()
+        self.dropped_events = Counter()
+        self.aggregate_stats = self.db.redis.register_script(
+            AGGREGATE_STATS_SCRIPT)
+        self.scheduler = Scheduler(self._run_plugin_event,
+                                   concurrency=max_concurrency,
+                                   max_queue=max_server_queue,
+                                   overflow=overflow, loop=self.loop)
+        self.http_sender = None
+        # Shards and workers all send as the same bot, they share the rate
+        # limits through Redis
+        multiprocess = self.shards > 1 or bool(event_bus_partitions)
+        self.outbox = Outbox(self._send_message,
+                             redis=self.db.redis if multiprocess else None,
+                             loop=self.loop)
+        self.event_bus = None
+        if event_bus_partitions:
+            self.event_bus = EventBus(self.db.redis, event_bus_partitions,
+                                      loop=self.loop)
+
+    def shard_key(self, key):
+        return 'rickbot:shard:{}:{}'.format(self.shard, key)
 
     async def on_ready(self):
         with open('welcome_ascii.txt') as f:
             print(f.read())
 
-        self.add_all_servers()
+        await self.add_all_servers()
+        # The workers don't connect to the gateway, this is how they know
+        # who they are
+        await self.db.redis.hset('rickbot:user', mapping={
+            'id': self.user.id,
+            'name': self.user.name,
+            'discriminator': self.user.discriminator,
+            'avatar': str(self.user.avatar)
+        })
+        discord.utils.create_task(self.listen_invalidations(), loop=self.loop)
         discord.utils.create_task(self.heartbeat(5), loop=self.loop)
         discord.utils.create_task(self.update_stats(60), loop=self.loop)
+        discord.utils.create_task(self.stats.run(self.stats_interval),
+                                  loop=self.loop)
+        discord.utils.create_task(self.publish_metrics(self.stats_interval),
+                                  loop=self.loop)
 
     async def add_all_servers(self):
-        log.debug('Syncing servers and DB')
-        self.db.redis.delete('servers')
-        for server in self.servers:
-            log.debug('Adding server {}\'s ID to DB'.format(server.id))
-            self.db.redis.sadd('servers', server.id)
+        log.debug('Syncing shard {} servers and DB'.format(self.shard))
+        key = self.shard_key('servers')
+        pipe = self.db.redis.pipeline()
+        pipe.delete(key)
+        server_ids = [server.id for server in self.servers]
+        if server_ids:
+            pipe.sadd(key, *server_ids)
+        # Every shard only knows its own servers, the global set is the
+        # union of all of them
+        pipe.sunionstore('servers', [
+            'rickbot:shard:{}:servers'.format(shard)
+            for shard in range(self.shards)
+        ])
+        await pipe.execute()
 
-    async def send_message(self, *args, **kwargs):
-        log.info('RickBot >> {}'.format(args[1].replace('\n', '~')))
-        await super().send_message(*args, **kwargs)
+    async def send_message(self, destination, content, priority=REPLY):
+        """ Queues the message in the outbox, see Outbox """
+        log.info('RickBot >> {}'.format(content.replace('\n', '~')))
+        self.outbox.put(destination, content, priority)
+
+    async def _send_message(self, destination, content):
+        if self.http_sender is not None:
+            return await self.http_sender(destination, content)
+        try:
+            await super().send_message(destination, content)
+        except discord.HTTPException as e:
+            response = getattr(e, 'response', None)
+            if getattr(response, 'status', None) == 429:
+                raise RateLimited(
+                    float(response.headers.get('Retry-After', 1)),
+                    response.headers.get('X-RateLimit-Global') == 'true')
+            raise
 
     async def on_server_join(self, server):
         log.info('Joined {} server: {}!'.format(server.owner.name, server.name))
         log.debug('Adding self {}\'s ID to DB'.format(server.id))
-        self.db.redis.sadd('servers', server.id)
-        self.db.redis.set('server:{}:name'.format(server.id), server.name)
+        await self.db.redis.sadd(self.shard_key('servers'), server.id)
+        await self.db.redis.sadd('servers', server.id)
+        await self.db.redis.set('server:{}:name'.format(server.id), server.name)
         if server.icon:
-            self.db.redis.set('server:{}:icon'.format(server.id), server.icon)
+            await self.db.redis.set('server:{}:icon'.format(server.id), server.icon)
 
     async def on_server_remove(self, server):
-        log.info('Leaving {} server: {}'.format(server.owner.name, sever.name))
+        log.info('Leaving {} server: {}'.format(server.owner.name, server.name))
         log.debug('Removing server {}\'s from DB'.format(server.id))
-        self.db.redis.srem('servers', server.id)
+        await self.db.redis.srem(self.shard_key('servers'), server.id)
+        await self.db.redis.srem('servers', server.id)
+        self.plugin_manager.invalidate(server.id)
+
+    async def listen_invalidations(self):
+        """ Drops cached server state when the dashboard changes it """
+        while self.is_logged_in:
+            pubsub = self.db.redis.pubsub()
+            try:
+                await pubsub.subscribe(*self.invalidation_handlers)
+                # Whatever was published while we weren't listening is lost
+                for handler in self.invalidation_handlers.values():
+                    handler(None)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    log.debug('Invalidating {} for server {}'.format(
+                        message['channel'],
+                        message['data']
+                    ))
+                    handler = self.invalidation_handlers[message['channel']]
+                    handler(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Lost the invalidation subscription')
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.reset()
 
     async def heartbeat(self, interval):
         while self.is_logged_in:
-            self.db.redis.set('heartbeat', 1, ex=interval)
+            # 'heartbeat' is up as long as any shard is
+            try:
+                pipe = self.db.redis.pipeline(transaction=False)
+                pipe.set(self.shard_key('heartbeat'), 1, ex=interval)
+                pipe.set('heartbeat', 1, ex=interval)
+                await pipe.execute()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Could not send the heartbeat')
             await asyncio.sleep(0.9 * interval)
 
-    async def update_stats(self, interval):
+    async def update_stats(self, interval, reconcile_every=60):
+        ticks = 0
         while self.is_logged_in:
-            # Total members and online members
-            members = list(self.get_all_members())
-            online_members = filter(lambda m: m.status is discord.Status.online,
-                                    members)
-            online_members = list(online_members)
-            self.db.redis.set('rickbot:stats:online_members',
-                              len(online_members))
-            self.db.redis.set('rickbot:stats:members', len(members))
-
-            # Last messages
-            for index, timestamp in enumerate(self.last_messages):
-                if timestamp + interval < time():
-                    self.last_messages.pop(index)
-            self.db.redis.set('rickbot:stats:last_messages',
-                              len(self.last_messages))
+            try:
+                await self.write_stats(interval, ticks % reconcile_every == 0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Our shard's keys expire if this keeps failing, until then
+                # the aggregated stats keep the last numbers we wrote
+                log.exception('Could not update the stats')
+            ticks += 1
+            await asyncio.sleep(interval)
+
+    async def write_stats(self, interval, reconcile=False):
+        # Total members and online members, kept up to date by the
+        # handle_member_* events. Recounted from scratch once in a while
+        # in case we missed some.
+        if reconcile:
+            self.member_counters.reconcile(self.get_all_members())
+        # Our own numbers go to the shard keys, expiring if we die
+        ex = int(3 * interval) + 1
+        gauges = {}
+        hashes = {}
+        gauges['online_members'] = self.member_counters.online
+        gauges['members'] = self.member_counters.members
+
+        # Last messages, over the last interval and per 1s/60s/5m
+        # window, globally and for each server
+        self.message_rates.prune()
+        rates = self.message_rates.rates()
+        gauges['last_messages'] = self.message_rates.total.count(interval)
+        for window in self.message_rates.windows:
+            gauges['last_messages:{}s'.format(window)] = rates[window]
+            hashes['server_last_messages:{}s'.format(window)] = {
+                server_id: counter.count(window)
+                for server_id, counter in self.message_rates.servers.items()
+            }
+
+        # Plugin events routing
+        gauges['events_dispatched'] = sum(self.dispatched_events.values())
+        gauges['events_dropped'] = sum(self.dropped_events.values())
+        if self.event_bus is not None:
+            gauges['events_published'] = self.event_bus.published
+            gauges['events_publish_errors'] = self.event_bus.publish_errors
+        # Plugin handlers waiting for their turn, and shed
+        gauges['scheduler_queued'] = self.scheduler.queued
+        gauges['scheduler_running'] = self.scheduler.running
+        for reason in ('overflow', 'coalesced'):
+            gauges['scheduler_shed:' + reason] = \
+                self.scheduler.shed[reason]
+        hashes['server_queued'] = self.scheduler.depths()
+        # Outgoing messages waiting for their channel's rate limit
+        gauges['outbox_queued'] = self.outbox.queued
+        for outcome in ('sent', 'coalesced', 'dropped', 'rate_limited',
+                        'failed'):
+            gauges['outbox:' + outcome] = self.outbox.counts[outcome]
+
+        pipe = self.db.redis.pipeline(transaction=False)
+        for name, value in gauges.items():
+            pipe.set(self.shard_key('stats:' + name), value, ex=ex)
+        for name, mapping in hashes.items():
+            key = self.shard_key('stats:' + name)
+            pipe.delete(key)
+            if mapping:
+                pipe.hset(key, mapping=mapping)
+                pipe.expire(key, ex)
+        await pipe.execute()
+        # Any shard can do the aggregation, it's the same for all
+        keys = []
+        for name in list(gauges) + list(hashes):
+            keys.append('rickbot:stats:' + name)
+            keys.extend('rickbot:shard:{}:stats:{}'.format(shard, name)
+                        for shard in range(self.shards))
+        await self.aggregate_stats(keys=keys, args=[self.shards, len(gauges)])
 
+    async def publish_metrics(self, interval):
+        """ Puts our metrics where the website's /metrics can read them """
+        key = 'rickbot:metrics:{}'.format(self.process_name)
+        while self.is_logged_in:
+            self.metrics.set('rickbot_scheduler_queued', (),
+                             self.scheduler.queued)
+            self.metrics.set('rickbot_scheduler_running', (),
+                             self.scheduler.running)
+            for reason, count in self.scheduler.shed.items():
+                self.metrics.set('rickbot_scheduler_shed',
+                                 (('reason', reason),), count)
+            self.metrics.set('rickbot_outbox_queued', (), self.outbox.queued)
+            self.metrics.set('rickbot_outbox_channels', (),
+                             len(self.outbox.channels))
+            for outcome, count in self.outbox.counts.items():
+                self.metrics.set('rickbot_outbox_messages',
+                                 (('outcome', outcome),), count)
+            try:
+                pipe = self.db.redis.pipeline(transaction=False)
+                pipe.set(key, self.metrics.render(), ex=int(3 * interval) + 1)
+                pipe.zadd('rickbot:metrics:processes',
+                          {self.process_name: time()})
+                # Forget the processes that are long gone
+                pipe.zremrangebyscore('rickbot:metrics:processes', 0,
+                                      time() - 3600)
+                await pipe.execute()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Could not publish the metrics')
             await asyncio.sleep(interval)
 
-    async def _run_plugin_event(self, plugin, event, *args, **kwargs):
-        # A yummy modified coroutine that is based on Client._run_event
+    def handle_member_join(self, member):
+        self.member_counters.member_join(member)
+
+    def handle_member_remove(self, member):
+        self.member_counters.member_remove(member)
+
+    def handle_member_update(self, before, after):
+        self.member_counters.member_update(before, after)
+
+    def handle_server_join(self, server):
+        self.member_counters.add_server(server)
+
+    def handle_server_remove(self, server):
+        self.member_counters.remove_server(server)
+
+    async def _run_plugin_event(self, handler, *args, **kwargs):
+        # A yummy modified coroutine that is based on Client._run_event.
+        # Returns whether the handler went through.
+        labels = (('plugin', type(handler.__self__).__name__),
+                  ('event', handler.__name__))
+        start = perf_counter()
+        ok = True
         try:
-            await getattr(plugin, event)(*args, **kwargs)
+            await handler(*args, **kwargs)
         except asyncio.CancelledError:
             pass
         except Exception:
+            ok = False
+            self.metrics.incr('rickbot_plugin_errors_total', labels)
             try:
-                await self.on_error(event, *args, **kwargs)
+                await self.on_error(handler.__name__, *args, **kwargs)
             except asyncio.CancelledError:
                 pass
+        self.metrics.observe('rickbot_plugin_event_seconds', labels,
+                             perf_counter() - start)
+        return ok
 
-    def dispatch(self, event, *args, **kwargs):
-        # A list of events that are avalible from the plugins.
-        plugin_events = (
-            'message',
-            'message_delete',
-            'message_edit',
-            'channel_delete',
-            'channel_create',
-            'channel_update',
-            'member_join',
-            'member_update',
-            'server_update',
-            'server_role_create',
-            'server_role_delete',
-            'server_role_update',
-            'voice_state_update',
-            'member_ban',
-            'member_unban',
-            'typing'
-        )
+    def _run_plugins(self, server, enabled_plugins, event, handlers, *args,
+                     **kwargs):
+        # For each plugin that the server has enabled
+        handlers = [(plugin, handler) for plugin, handler in handlers
+                    if plugin in enabled_plugins]
+        if not handlers:
+            self.dropped_events[event] += 1
+            return
+        self.dispatched_events[event] += 1
 
+        if self.event_bus is not None:
+            # The workers run them, they check the enabled plugins again
+            self.event_bus.publish(server, event, args, kwargs)
+            return
+
+        for plugin, handler in handlers:
+            key = plugin.coalesce_key(event, *args, **kwargs)
+            if key is not None:
+                key = (type(plugin).__name__, key)
+            self.scheduler.submit(server.id, handler, args, kwargs, key)
+
+    async def _dispatch_plugins(self, server, event, handlers, *args, **kwargs):
+        enabled_plugins = await self.plugin_manager.get_all(server)
+        self._run_plugins(server, enabled_plugins, event, handlers, *args,
+                          **kwargs)
+
+    def dispatch(self, event, *args, **kwargs):
         # Total number of messages stats update
         if event == 'message':
-            self.db.redis.incr('rickbot:stats:messages')
-            self.last_messages.append(time())
+            server_id = getattr(args[0].server, 'id', None)
+            self.stats.incr('rickbot:stats:messages')
+            if server_id is not None:
+                self.stats.incr('server:{}:stats:messages'.format(server_id))
+            self.message_rates.add(server_id)
 
         log.debug('Dispatching event {}'.format(event))
         method = 'on_' + event
@@ -123,30 +412,51 @@ class RickBot(discord.Client):
         if hasattr(self, handler):
             getattr(self, handler)(*args, **kwargs)
 
-        if event in plugin_events:
+        if event in PLUGIN_EVENTS:
+            # Nobody listens to most typing/presence events, bail out
+            # before looking for their server
+            handlers = self.plugin_manager.handlers.get(event)
+            if handlers is None:
+                self.dropped_events[event] += 1
+                return
+
             server_context = find_server(*args, **kwargs)
             if server_context is None:
+                self.dropped_events[event] += 1
                 return
 
-            # For each plugin that the server has enabled
-            for plugin in enabled_plugins:
-                if hasattr(plugin, method):
-                    discord.utils.create_task(self._run_plugin_event(\
-                    plugin, method, *args, **kwargs), loop=self.loop)
+            enabled_plugins = self.plugin_manager.get_cached(server_context)
+            if enabled_plugins is not None:
+                self._run_plugins(server_context, enabled_plugins, event,
+                                  handlers, *args, **kwargs)
+            else:
+                discord.utils.create_task(self._dispatch_plugins(\
+                server_context, event, handlers, *args, **kwargs),
+                loop=self.loop)
         else:
             if hasattr(self, method):
-                discord.utils.channel_create(self._run_event(method, *args, \
+                discord.utils.create_task(self._run_event(method, *args, \
                 **kwargs), loop=self.loop)
 
+    async def login(self, token, *args, **kwargs):
+        if self.api_base:
+            self.http_sender = HttpSender(token, self.api_base)
+        await super().login(token, *args, **kwargs)
+
+    async def shutdown(self):
+        await self.outbox.flush()
+        if self.http_sender is not None:
+            await self.http_sender.close()
+        await self.logout()
+        await self.stats.flush()
+        await self.db.close()
+
     def run(self, token):
-        self.token = token
-        self.headers['authorization'] = token
-        self._is_logged_in.set()
         try:
-            self.loop.run_until_complete(self.connect())
+            self.loop.run_until_complete(self.start(token))
         except KeyboardInterrupt:
-            self.loop.run_until_complete(self.logout())
-            pending = async.Task.all_tasks()
+            self.loop.run_until_complete(self.shutdown())
+            pending = asyncio.Task.all_tasks(self.loop)
             gathered = asyncio.gather(*pending)
             try:
                 gathered.cancel()
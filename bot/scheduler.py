@@ -0,0 +1,124 @@
+import logging
+from collections import Counter, OrderedDict, deque
+
+import discord
+
+log = logging.getLogger('discord')
+
+OVERFLOW_POLICIES = ('drop_oldest', 'coalesce')
+
+
+class ServerQueue(object):
+
+    def __init__(self):
+        self.jobs = deque()
+        # coalesce key -> number of queued jobs with it
+        self.keys = Counter()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def append(self, job):
+        self.jobs.append(job)
+        if job[3] is not None:
+            self.keys[job[3]] += 1
+
+    def popleft(self):
+        job = self.jobs.popleft()
+        self._forget(job)
+        return job
+
+    def pop_coalescable(self):
+        """ Removes the oldest job that has a coalesce key, if any """
+        for job in self.jobs:
+            if job[3] is not None:
+                self.jobs.remove(job)
+                self._forget(job)
+                return job
+        return None
+
+    def _forget(self, job):
+        key = job[3]
+        if key is not None:
+            self.keys[key] -= 1
+            if not self.keys[key]:
+                del self.keys[key]
+
+
+class Scheduler(object):
+    """ Runs the plugin handlers, at most `concurrency` at a time, taking
+    turns between the servers so a busy one can't starve the others.
+
+    Each server queues at most `max_queue` handlers. Past that the
+    `overflow` policy sheds some:
+    - drop_oldest: the oldest queued handler goes.
+    - coalesce: handlers with a coalesce key (e.g. a Levels XP award) go
+      first, oldest first, then the oldest handler. A handler whose key is
+      already queued for the server isn't queued twice either.
+    """
+
+    def __init__(self, run, concurrency=100, max_queue=1000,
+                 overflow='coalesce', loop=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {}'.format(overflow))
+        # Coroutine function running a handler, called as
+        # run(handler, *args, **kwargs)
+        self.run = run
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.loop = loop
+        # server id -> ServerQueue, in round-robin order. Only the servers
+        # with something queued are in there.
+        self.queues = OrderedDict()
+        self.queued = 0
+        self.running = 0
+        # reason -> number of handlers dropped
+        self.shed = Counter()
+
+    def submit(self, server_id, handler, args, kwargs, key=None):
+        queue = self.queues.get(server_id)
+        if queue is None:
+            queue = self.queues[server_id] = ServerQueue()
+
+        if key is not None and self.overflow == 'coalesce' and \
+                key in queue.keys:
+            self.shed['coalesced'] += 1
+            return
+
+        if len(queue) >= self.max_queue:
+            dropped = None
+            if self.overflow == 'coalesce':
+                dropped = queue.pop_coalescable()
+            if dropped is None:
+                dropped = queue.popleft()
+            self.queued -= 1
+            self.shed['overflow'] += 1
+
+        queue.append((handler, args, kwargs, key))
+        self.queued += 1
+        self.pump()
+
+    def pump(self):
+        while self.running < self.concurrency and self.queues:
+            server_id, queue = next(iter(self.queues.items()))
+            handler, args, kwargs, key = queue.popleft()
+            self.queued -= 1
+            if queue:
+                # Back of the line
+                self.queues.move_to_end(server_id)
+            else:
+                del self.queues[server_id]
+            self.running += 1
+            task = discord.utils.create_task(self.run(handler, *args, **kwargs),
+                                             loop=self.loop)
+            task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.running -= 1
+        self.pump()
+
+    def depths(self):
+        """ server id -> number of queued handlers """
+        return {server_id: len(queue)
+                for server_id, queue in self.queues.items()}
@@ -0,0 +1,89 @@
+import discord
+import asyncio
+import logging
+from collections import Counter
+
+log = logging.getLogger('discord')
+
+
+class StatsCounters(object):
+    """ Buffers counter increments in memory and writes them to Redis with
+    a single pipeline, instead of one INCR per event.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.counters = Counter()
+
+    def incr(self, key, amount=1):
+        self.counters[key] += amount
+
+    async def flush(self):
+        if not self.counters:
+            return
+        counters, self.counters = self.counters, Counter()
+        pipe = self.db.redis.pipeline(transaction=False)
+        for key, amount in counters.items():
+            pipe.incrby(key, amount)
+        try:
+            await pipe.execute()
+        except Exception:
+            # Keep them for the next flush rather than losing them
+            self.counters.update(counters)
+            raise
+
+    async def run(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Could not flush the stats counters')
+
+
+class MemberCounters(object):
+    """ Total and online members across every server, kept up to date from
+    the gateway events instead of walking every member.
+    """
+
+    def __init__(self):
+        self.members = 0
+        self.online = 0
+
+    @staticmethod
+    def _is_online(member):
+        return member.status is discord.Status.online
+
+    def reconcile(self, members):
+        """ Recounts everything from scratch, guards against drift """
+        total = online = 0
+        for member in members:
+            total += 1
+            if self._is_online(member):
+                online += 1
+        self.members, self.online = total, online
+
+    def add_server(self, server):
+        for member in server.members:
+            self.member_join(member)
+
+    def remove_server(self, server):
+        for member in server.members:
+            self.member_remove(member)
+
+    def member_join(self, member):
+        self.members += 1
+        if self._is_online(member):
+            self.online += 1
+
+    def member_remove(self, member):
+        self.members -= 1
+        if self._is_online(member):
+            self.online -= 1
+
+    def member_update(self, before, after):
+        was_online, is_online = self._is_online(before), self._is_online(after)
+        if was_online != is_online:
+            self.online += 1 if is_online else -1
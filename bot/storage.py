@@ -1,6 +1,7 @@
-from redis import Redis
-from redis import ConnectionPool
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
 from functools import wraps
+from time import perf_counter
 import inspect
 
 def prefixer(function, pref_type):
@@ -26,6 +27,9 @@ def prefixer(function, pref_type):
     elif pref_type == 'keys':
         @wraps(function)
         def wrapper(self, *args, **kwargs):
+            # keys can be given as one list too, mget(['a', 'b'])
+            if args and isinstance(args[0], (list, tuple)):
+                args = list(args[0]) + list(args[1:])
             args = list(map(lambda name: self.namespace + name, args))
             return function(self, *args, **kwargs)
         return wrapper
@@ -35,8 +39,14 @@ def prefix_methods(cls):
     for attr, value in inspect.getmembers(cls.__bases__[0]):
         method = value
         if inspect.isfunction(method):
-            args = inspect.getargspec(method)[0]
-            varargs = inspect.getargspec(method)[1]
+            # signature() follows the decorators redis-py puts on some
+            # commands (set, ...), getargspec() does not.
+            params = inspect.signature(method).parameters
+            args = [p.name for p in params.values()
+                    if p.kind is p.POSITIONAL_OR_KEYWORD]
+            varargs = [p.name for p in params.values()
+                       if p.kind is p.VAR_POSITIONAL]
+            varargs = varargs[0] if varargs else None
             if len(args) > 1 and args[1] == 'name':
                 setattr(cls, attr, prefixer(method, 'name'))
             elif varargs == 'names':
@@ -48,15 +58,54 @@ def prefix_methods(cls):
     return cls
 
 
+class MeteredPipeline(Pipeline):
+    """ Records its commands in `metrics` when executed, each one taking an
+    equal share of the round trip """
+
+    def __init__(self, *args, **kwargs):
+        self.metrics = kwargs.pop('metrics', None)
+        Pipeline.__init__(self, *args, **kwargs)
+
+    async def execute(self, raise_on_error=True):
+        commands = [args[0] for args, options in self.command_stack]
+        if self.metrics is None or not commands:
+            return await Pipeline.execute(self, raise_on_error)
+        start = perf_counter()
+        try:
+            return await Pipeline.execute(self, raise_on_error)
+        finally:
+            share = (perf_counter() - start) / len(commands)
+            for command in commands:
+                self.metrics.observe('rickbot_redis_command_seconds',
+                                     (('command', command),), share)
+
+
 @prefix_methods
 class Storage(Redis):
+    """ Namespaced asyncio Redis client.
+
+    Every command returns a coroutine, plugins have to await them so the
+    event loop keeps running while Redis answers. When given `metrics`,
+    the count and latency of every command is recorded there, pipelined
+    ones included.
+    """
 
     def __init__(self, *args, **kwargs):
         self.namespace = kwargs.pop('namespace')
+        self.metrics = kwargs.pop('metrics', None)
         Redis.__init__(self, *args, **kwargs)
 
-    @classmethod
-    def from_url(cls, url, db=None, **kwargs):
-        namespace = kwargs.pop('namespace')
-        connection_pool = ConnectionPool.from_url(url, db=db, **kwargs)
-        return cls(connection_pool=connection_pool, namespace=namespace)
+    async def execute_command(self, *args, **options):
+        if self.metrics is None:
+            return await Redis.execute_command(self, *args, **options)
+        start = perf_counter()
+        try:
+            return await Redis.execute_command(self, *args, **options)
+        finally:
+            self.metrics.observe('rickbot_redis_command_seconds',
+                                 (('command', args[0]),),
+                                 perf_counter() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return MeteredPipeline(self.connection_pool, self.response_callbacks,
+                               transaction, shard_hint, metrics=self.metrics)
@@ -0,0 +1,204 @@
+""" Runs the plugins on the events the gateway puts in the event bus
+
+    RICKBOT_EVENT_BUS_PARTITIONS must match the gateway's. By default every
+    worker reads every partition and the consumer group spreads the entries.
+    RICKBOT_WORKER_ID/RICKBOT_WORKERS pin the partitions to the workers
+    instead, so a server's events are always handled by the same one.
+    RICKBOT_WORKER_PROCESSES workers (default: one per core) are started on
+    this host.
+"""
+import asyncio
+import logging
+import os
+from time import time
+
+import discord
+
+from rickbot import RickBot
+from event_bus import Snapshot, decode_event
+from utils import find_server
+from launcher import supervise
+
+log = logging.getLogger('discord')
+
+
+class Worker(RickBot):
+    """ A RickBot that doesn't connect to the gateway, it talks to Discord
+    over HTTP only, to send the plugins' messages """
+
+    def __init__(self, *args, **kwargs):
+        worker_id = kwargs.pop('worker_id', None)
+        workers = kwargs.pop('workers', None)
+        # Events handled at the same time
+        self.concurrency = kwargs.pop('concurrency', 100)
+        # Seconds before taking over the entries of a dead worker
+        self.claim_after = kwargs.pop('claim_after', 60)
+        kwargs.setdefault('event_bus_partitions', 16)
+        # Unless the partitions are pinned, a server's events go to every
+        # worker and only Redis can tell who's on cooldown
+        if kwargs.get('shared_cooldowns') is None:
+            kwargs['shared_cooldowns'] = not workers
+        super().__init__(*args, **kwargs)
+        self.consumer = 'worker:{}'.format(self.process_name)
+        self.partitions = list(range(self.event_bus.partitions))
+        if workers:
+            self.partitions = [partition for partition in self.partitions
+                               if partition % workers == worker_id]
+
+    async def get_bot_user(self):
+        """ Waits for the gateway to tell who we are """
+        while True:
+            user = await self.db.redis.hgetall('rickbot:user')
+            if user:
+                return Snapshot('User', user)
+            log.info('Waiting for the gateway to be ready')
+            await asyncio.sleep(5)
+
+    async def start(self, token):
+        # Only the HTTP session, no gateway connection
+        await self.login(token)
+        self.user = await self.get_bot_user()
+        await self.event_bus.create_groups(self.partitions)
+        discord.utils.create_task(self.listen_invalidations(), loop=self.loop)
+        discord.utils.create_task(self.publish_metrics(self.stats_interval),
+                                  loop=self.loop)
+        discord.utils.create_task(self.report_lag(self.stats_interval),
+                                  loop=self.loop)
+        await self.consume()
+
+    async def shutdown(self):
+        self._is_logged_in.clear()
+        await self.outbox.flush()
+        if self.http_sender is not None:
+            await self.http_sender.close()
+        await self.http.close()
+        await self.db.close()
+
+    async def consume(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        last_claim = time()
+        while self.is_logged_in:
+            try:
+                entries = await self.event_bus.read(self.consumer,
+                                                    self.partitions)
+                if time() - last_claim > self.claim_after / 2:
+                    last_claim = time()
+                    entries += await self.event_bus.claim_stale(
+                        self.consumer, self.partitions, self.claim_after)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Could not read the event bus')
+                await asyncio.sleep(1)
+                continue
+
+            # Events start in order, a slow handler doesn't hold back the
+            # ones after it
+            for stream, entry_id, fields in entries:
+                await slots.acquire()
+                task = discord.utils.create_task(
+                    self.handle_entry(stream, entry_id, fields),
+                    loop=self.loop)
+                task.add_done_callback(lambda task: slots.release())
+
+    async def handle_entry(self, stream, entry_id, fields):
+        event = fields.get('event')
+        try:
+            args, kwargs = decode_event(fields['payload'])
+        except Exception:
+            log.exception('Could not decode {} {}'.format(stream, entry_id))
+            await self.event_bus.dead_letter(stream, entry_id, fields,
+                                             'undecodable')
+            return
+
+        try:
+            delay = float(fields.get('not_before', 0)) - time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # Retries only run the plugins that failed
+            only = fields.get('plugins')
+            if only:
+                only = set(only.split(','))
+            server = find_server(*args, **kwargs)
+            enabled_plugins = await self.plugin_manager.get_all(server)
+            handlers = [
+                (plugin, handler)
+                for plugin, handler in self.plugin_manager.handlers.get(event, ())
+                if plugin in enabled_plugins and
+                (not only or type(plugin).__name__ in only)
+            ]
+            if not handlers:
+                self.dropped_events[event] += 1
+                await self.event_bus.ack(stream, entry_id)
+                return
+
+            self.dispatched_events[event] += 1
+            results = await asyncio.gather(*[
+                self._run_plugin_event(handler, *args, **kwargs)
+                for plugin, handler in handlers
+            ])
+            failed = [type(plugin).__name__
+                      for (plugin, handler), ok in zip(handlers, results)
+                      if not ok]
+            if failed:
+                await self.event_bus.retry(stream, entry_id, fields, failed)
+            else:
+                await self.event_bus.ack(stream, entry_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Not acked, claim_stale will give it another go
+            log.exception('Could not handle {} {}'.format(stream, entry_id))
+
+    async def report_lag(self, interval):
+        while self.is_logged_in:
+            try:
+                lag = await self.event_bus.lag(self.partitions)
+                pipe = self.db.redis.pipeline(transaction=False)
+                for partition, (behind, pending) in lag.items():
+                    labels = (('partition', partition),)
+                    self.metrics.set('rickbot_event_bus_lag', labels, behind)
+                    self.metrics.set('rickbot_event_bus_pending', labels,
+                                     pending)
+                    pipe.hset('rickbot:stats:event_bus:lag', partition,
+                              behind)
+                    pipe.hset('rickbot:stats:event_bus:pending', partition,
+                              pending)
+                await pipe.execute()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Could not report the event bus lag')
+            await asyncio.sleep(interval)
+
+
+def run_worker(worker_id, workers):
+    import bot
+    worker = Worker(redis_url=bot.redis_url,
+                    stats_interval=bot.stats_interval,
+                    event_bus_partitions=bot.event_bus_partitions or 16,
+                    api_base=bot.api_base,
+                    shared_cooldowns=bot.shared_cooldowns,
+                    worker_id=worker_id, workers=workers)
+    worker.run(bot.token)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    processes = int(os.getenv('RICKBOT_WORKER_PROCESSES',
+                              os.cpu_count() or 1))
+    workers = os.getenv('RICKBOT_WORKERS')
+    if workers is None:
+        jobs = {'rickbot-worker-{}'.format(i): (run_worker, (None, None))
+                for i in range(processes)}
+    else:
+        # Pinned partitions, this host runs the workers from RICKBOT_WORKER_ID
+        first = int(os.getenv('RICKBOT_WORKER_ID', 0))
+        jobs = {'rickbot-worker-{}'.format(i): (run_worker, (i, int(workers)))
+                for i in range(first, first + processes)}
+    supervise(jobs)
+
+
+if __name__ == '__main__':
+    main()
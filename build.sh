@@ -1 +1 @@
-git pull && cd bot/ && docker-build -t rickbot-bot . && cd ../website && docker-build -t rickbot-web . && cd ../
+git pull && cd bot/ && docker-build -t rickbot-bot . && cd ../ && docker-build -f website/Dockerfile -t rickbot-web .
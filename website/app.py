@@ -3,11 +3,27 @@ redirect, jsonify, make_response, flash, abort
 import os
 from functools import wraps
 from requests_oauthlib import OAuth2Session
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+import requests
 import redis
 import json
 import binascii
+import hashlib
+import csv
+import io
+import time
 import re
-from math import floor
+import sys
+try:
+    import level_curve
+except ImportError:
+    # Running from a checkout, the image has it next to app.py
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '..', 'bot'))
+    import level_curve
+from sessions import RedisSessionInterface
+from datetime import datetime, timezone, timedelta
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY", "\x10\xdf\xba\xed\xe5Ih\x17U\nQb~\x99\x01")
@@ -20,9 +36,29 @@ API_BASE_URL = os.environ.get('API_BASE_URL', 'https://discordapp.com/api')
 AUTHORIZATION_BASE_URL = API_BASE_URL + '/oauth2/authorize'
 TOKEN_URL = API_BASE_URL + '/oauth2/token'
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+# How long a user's identity and guilds are trusted before asking Discord
+DISCORD_CACHE_TTL = int(os.environ.get('DISCORD_CACHE_TTL', 300))
+
+# Kept alive and shared by every request of the worker. Point API_BASE_URL
+# at a local fake to run without Discord.
+discord_http = requests.Session()
+discord_http.mount('http://', HTTPAdapter(pool_maxsize=20))
+discord_http.mount('https://', HTTPAdapter(pool_maxsize=20))
+discord_executor = ThreadPoolExecutor(max_workers=8)
 
 db = redis.Redis.from_url(REDIS_URL, decode_responses=True)
 
+# Sessions live in Redis, the cookie only carries an opaque session id
+app.session_interface = RedisSessionInterface(db)
+app.permanent_session_lifetime = timedelta(
+    seconds=int(os.environ.get('SESSION_TTL', 7*24*3600)))
+
+# The bot caches each server's enabled plugins and drops them when a
+# server id is published here
+PLUGINS_CHANNEL = 'rickbot:invalidate:plugins'
+# Same for each server's custom commands
+COMMANDS_CHANNEL = 'rickbot:invalidate:commands'
+
 # CSRF Security
 @app.before_request
 def csrf_protect():
@@ -76,7 +112,8 @@ def about():
 
 @app.route('/logout')
 def logout():
-    session.pop('user')
+    # Drops the whole session, the oauth2 token with it
+    session.clear()
 
     return redirect(url_for('index'))
 
@@ -102,18 +139,67 @@ def confirm_login():
         TOKEN_URL,
         client_secret=OAUTH2_CLIENT_SECRET,
         authorization_response=request.url)
+    # Whatever session id we had before logging in is no good anymore
+    session.regenerate()
+    session.pop('oauth2_state', None)
     session['oauth2_token'] = token
-    get_or_update_user()
+    get_or_update_user(refresh=True)
 
     return redirect(url_for('select_server'))
 
-def get_or_update_user():
+def discord_api_get(path, token):
+    response = discord_http.get(
+        API_BASE_URL + path,
+        headers={'Authorization': 'Bearer ' + token['access_token']},
+        timeout=10)
+    response.raise_for_status()
+    return response.json()
+
+def fetch_discord_user(token):
+    """ The user and their guilds, both asked for at the same time """
+    user = discord_executor.submit(discord_api_get, '/users/@me', token)
+    guilds = discord_executor.submit(discord_api_get, '/users/@me/guilds',
+                                     token)
+    return user.result(), compact_guilds(guilds.result())
+
+def compact_guilds(guilds):
+    """ Only what the dashboard uses: the guilds the user owns, and their
+    id, name and icon """
+    return [{'id': g['id'], 'name': g['name'], 'icon': g['icon']}
+            for g in guilds if g['owner'] is True]
+
+def refresh_oauth2_token(token):
+    discord = make_session(token=token)
+    token = discord.refresh_token(TOKEN_URL, client_id=OAUTH2_CLIENT_ID,
+                                  client_secret=OAUTH2_CLIENT_SECRET)
+    token_updater(token)
+    return token
+
+def discord_cache_key(token):
+    return 'website:discord:{}'.format(hashlib.sha1(
+        token['access_token'].encode()).hexdigest())
+
+def get_or_update_user(refresh=False):
     oauth2_token = session.get('oauth2_token')
     if oauth2_token:
-        discord = make_session(token=oauth2_token)
-        session['user'] = discord.get(API_BASE_URL + '/users/@me').json()
-        session['guilds'] = discord.get(
-                            API_BASE_URL + '/users/@me/guilds').json()
+        cache_key = discord_cache_key(oauth2_token)
+        cached = None if refresh else db.get(cache_key)
+        if cached:
+            user, guilds = json.loads(cached)
+        else:
+            try:
+                user, guilds = fetch_discord_user(oauth2_token)
+            except requests.HTTPError as e:
+                if e.response.status_code != 401:
+                    raise
+                oauth2_token = refresh_oauth2_token(oauth2_token)
+                user, guilds = fetch_discord_user(oauth2_token)
+                # The next requests come with the new token
+                cache_key = discord_cache_key(oauth2_token)
+            db.setex(cache_key, DISCORD_CACHE_TTL, json.dumps([user, guilds]))
+
+        session['user'] = user
+        session['guilds'] = guilds
         if session['user'].get('avatar') is None:
             session['user']['avatar'] = url_for('static',
                                                 filename='img/no_logo.png')
@@ -122,8 +208,17 @@ def get_or_update_user():
             + session['user']['id'] + "/" + session['user']['avatar'] + ".jpg"
 
 
+def enable_plugin(server_id, plugin):
+    if db.sadd('plugins:{}'.format(server_id), plugin):
+        db.publish(PLUGINS_CHANNEL, server_id)
+
+def disable_plugin(server_id, plugin):
+    if db.srem('plugins:{}'.format(server_id), plugin):
+        db.publish(PLUGINS_CHANNEL, server_id)
+
 def get_user_servers(user, guilds):
-    return list(filter(lambda g: g['owner'] is True, guilds))
+    # compact_guilds() already dropped the ones the user doesn't own
+    return guilds
 
 @app.route('/servers')
 @require_auth
@@ -132,7 +227,9 @@ def select_server():
     if guild_id:
         return redirect(url_for('dashboard', server_id=int(guild_id)))
 
-    get_or_update_user()
+    # ?refresh=1 to see a server you just created without waiting for the
+    # cache to expire
+    get_or_update_user(refresh=bool(request.args.get('refresh')))
     user_servers = get_user_servers(session['user'], session['guilds'])
 
     return render_template('select-server.html', user_servers=user_servers)
@@ -186,23 +283,15 @@ def dashboard(server_id):
 def plugin_commands(server_id):
     disable = request.args.get('disable')
     if disable:
-        db.srem('plugins:{}'.format(server_id), 'Commands')
+        disable_plugin(server_id, 'Commands')
         return redirect(url_for('dashboard', server_id=server_id))
 
-    db.sadd('plugins:{}'.format(server_id), 'Commands')
+    enable_plugin(server_id, 'Commands')
     servers = session['guilds']
     server = list(filter(lambda g: g['id'] == str(server_id), servers))[0]
     enabled_plugins = db.smembers('plugins:{}'.format(server_id))
 
-    commands = []
-    commands_names = db.smembers('Commands.{}:commands'.format(server_id))
-    for cmd in commands_names:
-        command = {
-            'name': cmd,
-            'message': db.get('Commands.{}:command:{}'.format(server_id, cmd))
-        }
-        commands.append(command)
-    commands = sorted(commands, key=lambda k: k['name'])
+    commands = get_commands(server_id)
 
     return render_template('plugin-commands.html',
         server=server,
@@ -211,30 +300,50 @@ def plugin_commands(server_id):
     )
 
 
-@app.route('/dashboard/commands/add', methods=['POST'])
+def get_commands(server_id):
+    """ Every command of the server, sorted by name, in two round trips """
+    commands_names = sorted(db.smembers('Commands.{}:commands'.format(server_id)))
+    if not commands_names:
+        return []
+    messages = db.mget(['Commands.{}:command:{}'.format(server_id, cmd)
+                        for cmd in commands_names])
+    return [{'name': cmd, 'message': message}
+            for cmd, message in zip(commands_names, messages)]
+
+def command_error(cmd_name, cmd_message, edit=False):
+    """ What's wrong with a command, None if it's fine """
+    if len(cmd_name) == 0 or len(cmd_name) > 15:
+        return 'The name of a command should be between 1 and 15 characters '\
+               'long'
+    elif not edit and not re.match("^[A-Za-z0-9_-]*$", cmd_name):
+        return 'A command name should only contain letters from a-z, numbers,'\
+               ' _ or -'
+    elif len(cmd_message) == 0 or len(cmd_message) > 2000:
+        return 'A command message should not be longer than 2000 characters.'
+    return None
+
+
+@app.route('/dashboard/<int:server_id>/commands/add', methods=['POST'])
+@require_auth
+@require_bot_admin
+@server_check
 def add_command(server_id):
     cmd_name = request.form.get('cmd_name', '')
     cmd_message = request.form.get('cmd_message', '')
 
-    edit = cmd_name in db.smembers('Commands.{}:commands'.format(server_id))
-    print(edit)
+    edit = db.sismember('Commands.{}:commands'.format(server_id), cmd_name)
 
-    cb = url_for('plugin-commands', server_id=server_id)
-    if len(cmd_name) == 0 or len(cmd_name) > 15:
-        flash('The name of a command should be between 1 and 15 characters '\
-              'long', 'danger')
-    elif not edit and not re.match("^[A-Za-z0-9_-]*$", cmd_name):
-        flash('A command name should only contain letters from a-z, numbers,'\
-              ' _ or -', 'danger')
-    elif len(cmd_message) == 0 or len(cmd_message) > 2000:
-        flash('A command message should not be longer than 2000 characters.',
-              'danger')
+    cb = url_for('plugin_commands', server_id=server_id)
+    error = command_error(cmd_name, cmd_message, edit)
+    if error:
+        flash(error, 'danger')
     else:
         if not edit:
             cmd_name = '!' + cmd_name
-        db.sadd('Commands.{}:'.format(server_id), cmd_name)
+        db.sadd('Commands.{}:commands'.format(server_id), cmd_name)
         db.set('Commands.{}:command:{}'.format(server_id, cmd_name),
                cmd_message)
+        db.publish(COMMANDS_CHANNEL, server_id)
         if edit:
             flash('Command {} edited!'.format(cmd_name), 'success')
         else:
@@ -249,9 +358,112 @@ def add_command(server_id):
 @server_check
 def delete_command(server_id, command):
     db.srem('Commands.{}:commands'.format(server_id), command)
-    db.delete('Commands.{}:command'.format(server_id, command))
+    db.delete('Commands.{}:command:{}'.format(server_id, command))
+    db.publish(COMMANDS_CHANNEL, server_id)
     flash('Command {} deleted!'.format(command), 'success')
-    return redirect(url_for('plugin-commands', server_id=server_id))
+    return redirect(url_for('plugin_commands', server_id=server_id))
+
+
+@app.route('/dashboard/<int:server_id>/commands/export')
+@require_auth
+@require_bot_admin
+@server_check
+def export_commands(server_id):
+    commands = get_commands(server_id)
+    if request.args.get('format') == 'csv':
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(['name', 'message'])
+        for cmd in commands:
+            writer.writerow([cmd['name'], cmd['message']])
+        response = make_response(out.getvalue())
+        response.mimetype = 'text/csv'
+        filename = 'commands-{}.csv'.format(server_id)
+    else:
+        response = make_response(json.dumps(commands, indent=2))
+        response.mimetype = 'application/json'
+        filename = 'commands-{}.json'.format(server_id)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename={}'.format(filename)
+    return response
+
+
+MAX_IMPORTED_COMMANDS = 1000
+# 1000 commands of 2000 characters, with room for escaping. Werkzeug
+# refuses bigger requests before reading them.
+MAX_IMPORT_BYTES = 8 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_IMPORT_BYTES
+
+@app.errorhandler(413)
+def request_too_large(e):
+    flash('That is too much at once, imports are limited to {} MB.'.format(
+        MAX_IMPORT_BYTES // (1024 * 1024)), 'danger')
+    return redirect(request.referrer or url_for('index'))
+
+def parse_commands(data, fmt):
+    """ [(name, message)] out of a JSON list of {name, message} objects or
+    a CSV file with name and message columns """
+    if fmt == 'csv':
+        rows = csv.DictReader(io.StringIO(data))
+    else:
+        rows = json.loads(data)
+        if not isinstance(rows, list):
+            raise ValueError('expected a list of commands')
+    commands = []
+    for row in rows:
+        if not isinstance(row, dict):
+            raise ValueError('expected name and message for every command')
+        commands.append((str(row.get('name') or ''),
+                         str(row.get('message') or '')))
+    return commands
+
+
+@app.route('/dashboard/<int:server_id>/commands/import', methods=['POST'])
+@require_auth
+@require_bot_admin
+@server_check
+def import_commands(server_id):
+    cb = url_for('plugin_commands', server_id=server_id)
+    upload = request.files.get('commands_file')
+    if upload and upload.filename:
+        data = upload.read().decode('utf-8-sig', errors='replace')
+        fmt = 'csv' if upload.filename.lower().endswith('.csv') else 'json'
+    else:
+        data = request.form.get('commands', '')
+        fmt = request.form.get('format', 'json')
+
+    try:
+        commands = parse_commands(data, fmt)
+    except (ValueError, csv.Error) as e:
+        flash('Could not read the commands: {}'.format(e), 'danger')
+        return redirect(cb)
+
+    if len(commands) == 0 or len(commands) > MAX_IMPORTED_COMMANDS:
+        flash('You can import between 1 and {} commands at once.'.format(
+            MAX_IMPORTED_COMMANDS), 'danger')
+        return redirect(cb)
+
+    # Everything is checked before anything is written
+    to_import = {}
+    for cmd_name, cmd_message in commands:
+        if cmd_name.startswith('!'):
+            cmd_name = cmd_name[1:]
+        error = command_error(cmd_name, cmd_message)
+        if error:
+            flash('{} ({})'.format(error, cmd_name or 'unnamed command'),
+                  'danger')
+            return redirect(cb)
+        to_import['!' + cmd_name] = cmd_message
+
+    pipe = db.pipeline()
+    pipe.sadd('Commands.{}:commands'.format(server_id), *to_import)
+    pipe.mset({'Commands.{}:command:{}'.format(server_id, name): message
+               for name, message in to_import.items()})
+    pipe.publish(COMMANDS_CHANNEL, server_id)
+    pipe.execute()
+
+    flash('{} commands imported!'.format(len(to_import)), 'success')
+    return redirect(cb)
 
 
 @app.route('/dashboard/<int:server_id>/help')
@@ -261,10 +473,10 @@ def delete_command(server_id, command):
 def plugin_help(server_id):
     disable = request.args.get("disable")
     if disable:
-        db.srem('plugins:{}'.format(server_id), 'Help')
+        disable_plugin(server_id, 'Help')
         return redirect(url_for('dashboard', server_id=server_id))
 
-    db.sadd('plugins:{}'.format(server_id), 'Help')
+    enable_plugin(server_id, 'Help')
 
     servers = session['guilds']
     server = list(filter(lambda g: g['id'] == str(server_id), servers))[0]
@@ -283,9 +495,9 @@ def plugin_help(server_id):
 def plugin_levels(server_id):
     disable = request.args.get('disable')
     if disable:
-        db.srem('plugin:{}'.format(server_id), 'Levels')
+        disable_plugin(server_id, 'Levels')
         return redirect(url_for('dashboard', server_id=server_id))
-    db.sadd('plugins:{}'.format(server_id), 'Levels')
+    enable_plugin(server_id, 'Levels')
     servers = session['guilds']
     server = list(filter(lambda g: g['id']==str(server_id), servers))[0]
     enabled_plugins = db.smembers('plugins:{}'.format(server_id))
@@ -332,57 +544,194 @@ def update_levels(server_id):
     return redirect(url_for('plugin_levels', server_id=server_id))
 
 
+PROFILE_FIELDS = ('name', 'avatar', 'discriminator')
+LEADERBOARD_FIELDS = ('rank', 'id', 'total_xp', 'lvl', 'xp', 'lvl_xp',
+                      'xp_percent') + PROFILE_FIELDS
+
+# How long a rendered leaderboard is served to everyone before being
+# rendered again, absorbs the traffic when a big server shares its link
+LEVELS_CACHE_TTL = int(os.environ.get('LEVELS_CACHE_TTL', 10))
+
 @app.route('/levels/<int:server_id>')
 def levels(server_id):
-    server_check = str(server_id) in db.smembers('servers')
+    cache_key = 'website:levels:{}'.format(server_id)
+    pipe = db.pipeline(transaction=False)
+    pipe.sismember('servers', server_id)
+    pipe.sismember('plugins:{}'.format(server_id), 'Levels')
+    pipe.hgetall(cache_key)
+    server_check, plugin_check, cached = pipe.execute()
     if not server_check:
         return redirect(url_for('index'))
-    plugin_check = 'Levels' in db.smembers('plugin:{}'.format(server_id))
     if not plugin_check:
         return redirect(url_for('index'))
 
+    # The navbar shows who's logged in, their page is theirs only
+    if 'user' in session:
+        response = make_response(render_levels(server_id))
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
+
+    if not cached:
+        # The bot bumps the version whenever xp or profiles change
+        version = db.hgetall('Levels.{}:leaderboard:version'.format(server_id))
+        cached = {
+            'version': version.get('version', '0'),
+            'modified': version.get('modified', '0')
+        }
+        if request_is_fresh(server_id, cached):
+            return not_modified(server_id, cached)
+        cached['body'] = render_levels(server_id)
+        pipe = db.pipeline()
+        pipe.hset(cache_key, mapping=cached)
+        pipe.expire(cache_key, LEVELS_CACHE_TTL)
+        pipe.execute()
+    elif request_is_fresh(server_id, cached):
+        return not_modified(server_id, cached)
+
+    response = make_response(cached['body'])
+    return set_levels_validators(response, server_id, cached)
+
+def levels_etag(server_id, version):
+    return 'levels-{}-{}'.format(server_id, version['version'])
+
+def request_is_fresh(server_id, version):
+    # Only the version tells, If-Modified-Since can't see two changes
+    # within the same second
+    if request.if_none_match:
+        return request.if_none_match.contains(levels_etag(server_id, version))
+    return False
+
+def not_modified(server_id, version):
+    response = make_response('', 304)
+    return set_levels_validators(response, server_id, version)
+
+def set_levels_validators(response, server_id, version):
+    response.set_etag(levels_etag(server_id, version))
+    response.last_modified = datetime.fromtimestamp(int(version['modified']),
+                                                    timezone.utc)
+    # Let browsers keep it, but always check it's still the latest one. The
+    # same browser gets another page once logged in.
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+def get_leaderboard(server_id, start, count, fields=LEADERBOARD_FIELDS):
+    """ `count` players of the leaderboard from rank `start` (0 based), as
+    dicts with only `fields` in them """
+    leaderboard = db.zrevrange('Levels.{}:leaderboard'.format(server_id),
+                               start, start + count - 1, withscores=True)
+
+    profile_fields = [f for f in PROFILE_FIELDS if f in fields]
+    profiles = [{} for _ in leaderboard]
+    if profile_fields:
+        pipe = db.pipeline(transaction=False)
+        for player_id, _ in leaderboard:
+            pipe.hmget('Levels.{}:player:{}'.format(server_id, player_id),
+                       *profile_fields)
+        profiles = [dict(zip(profile_fields, values))
+                    for values in pipe.execute()]
+
+    progress = level_curve.progress_many(xp for _, xp in leaderboard)
+
+    players = []
+    for i, (player_id, total_xp) in enumerate(leaderboard):
+        player = progress[i]
+        player.update(profiles[i])
+        player.update({
+            'id': player_id,
+            'rank': start + i + 1,
+            'total_xp': int(total_xp)
+        })
+        players.append({f: player[f] for f in fields})
+    return players
+
+def render_levels(server_id):
     server = {
         'id': server_id,
         'icon': db.get('server:{}:icon'.format(server_id)),
         'name': db.get('server:{}:name'.format(server_id))
     }
 
-    _players = db.sort('Levels.{}:players'.format(server_id),
-                by='Levels.{}:player:*:xp'.format(server_id),
-                get=[
-                    'Levels.{}:player:*:xp'.format(server_id),
-                    'Levels.{}:player:*:lvl'.format(server_id),
-                    'Levels.{}:player:*:name'.format(server_id),
-                    'Levels.{}:player:*:avatar'.format(server_id),
-                    'Levels.{}:player:*:discriminator'.format(server_id),
-                    '#'
-                    ],
-                start=0,
-                num=100,
-                desc=True)
-
-    players = []
-    for i in range(0, len(_player),6):
-        lvl = int(_players[i+1])
-        x = 0
-        for l in range(0,lvl):
-            x += 100*(1.2**1)
-        remaining_xp = int(int(_players[i]) - x)
-        player = {
-            'xp': remaining_xp,
-            'lvl': _players[i+1],
-            'lvl_xp': int(100*(1.2**lvl)),
-            'xp_percent': floor(100*(remaining_xp)/(100*(1.2**lvl))),
-            'name': _players[i+2],
-            'avatar': _players[i+3],
-            'discriminator': _players[i+4],
-            'id': _players[i+5]
-        }
-        players.append(player)
+    players = get_leaderboard(server_id, 0, 100)
     return render_template('levels.html', players=players, server=server,
         title="{} leaderboard - RickBot".format(server['name']))
 
 
+@app.route('/api/levels/<int:server_id>')
+def api_levels(server_id):
+    """ A page of the leaderboard as JSON.
+
+    `cursor` is the rank to start from (0 based, what the previous page
+    returned as `next_cursor`), `limit` the page size (100 max) and
+    `fields` a comma separated subset of LEADERBOARD_FIELDS.
+    """
+    pipe = db.pipeline(transaction=False)
+    pipe.sismember('servers', server_id)
+    pipe.sismember('plugins:{}'.format(server_id), 'Levels')
+    pipe.zcard('Levels.{}:leaderboard'.format(server_id))
+    server_check, plugin_check, total = pipe.execute()
+    if not server_check or not plugin_check:
+        return make_response(jsonify(error='Unknown leaderboard'), 404)
+
+    try:
+        cursor = max(int(request.args.get('cursor', 0)), 0)
+        limit = min(max(int(request.args.get('limit', 50)), 1), 100)
+    except ValueError:
+        return make_response(jsonify(error='Bad cursor or limit'), 400)
+    fields = LEADERBOARD_FIELDS
+    if request.args.get('fields'):
+        fields = tuple(request.args['fields'].split(','))
+        unknown = set(fields) - set(LEADERBOARD_FIELDS)
+        if unknown:
+            return make_response(jsonify(
+                error='Unknown fields: {}'.format(', '.join(sorted(unknown)))
+            ), 400)
+
+    players = get_leaderboard(server_id, cursor, limit, fields)
+    next_cursor = cursor + limit
+    if next_cursor >= total:
+        next_cursor = None
+    return jsonify(players=players, total=total, next_cursor=next_cursor)
+
+
+# Bot processes that didn't publish for that long are left out
+METRICS_MAX_AGE = 60
+
+@app.route('/metrics')
+def metrics():
+    """ Every bot process's metrics, in the Prometheus text format """
+    processes = db.zrangebyscore('rickbot:metrics:processes',
+                                 time.time() - METRICS_MAX_AGE, '+inf')
+    texts = []
+    if processes:
+        texts = db.mget(['rickbot:metrics:{}'.format(process)
+                         for process in processes])
+
+    # Each process renders its families together, merge them so every
+    # family has a single TYPE line
+    families = {}
+    for text in filter(None, texts):
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                _, _, name, kind = line.split(' ')
+                family = families.setdefault(name, (kind, []))
+            elif line and family is not None:
+                family[1].append(line)
+
+    lines = []
+    for name, (kind, samples) in sorted(families.items()):
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.extend(samples)
+    response = make_response('\n'.join(lines) + '\n')
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return response
+
+
 if __name__ == '__main__':
     app.debug = True
     app.run()
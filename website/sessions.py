@@ -0,0 +1,78 @@
+import json
+import secrets
+from werkzeug.datastructures import CallbackDict
+from flask.sessions import SessionInterface, SessionMixin
+
+
+def generate_sid():
+    return secrets.token_urlsafe(32)
+
+
+class RedisSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Set by regenerate(), deleted from Redis when saving
+        self.old_sid = None
+
+    def regenerate(self):
+        """ Moves the session to a new id, e.g. on login, so an id known
+        before can't be used after """
+        if not self.new and self.old_sid is None:
+            self.old_sid = self.sid
+        self.sid = generate_sid()
+        self.modified = True
+
+
+class RedisSessionInterface(SessionInterface):
+    """ Keeps the session in Redis, the cookie only holds its random id.
+
+    Sessions expire from Redis after app.permanent_session_lifetime without
+    being used.
+    """
+
+    session_class = RedisSession
+
+    def __init__(self, redis, prefix='session:'):
+        self.redis = redis
+        self.prefix = prefix
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if not sid:
+            return self.session_class(sid=generate_sid(), new=True)
+        data = self.redis.get(self.prefix + sid)
+        if data is not None:
+            return self.session_class(json.loads(data), sid=sid)
+        return self.session_class(sid=generate_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.old_sid is not None:
+            self.redis.delete(self.prefix + session.old_sid)
+            session.old_sid = None
+        if not session:
+            if session.modified:
+                self.redis.delete(self.prefix + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        ttl = app.permanent_session_lifetime
+        if session.modified or session.new:
+            self.redis.setex(self.prefix + session.sid, ttl,
+                             json.dumps(dict(session)))
+        else:
+            self.redis.expire(self.prefix + session.sid, ttl)
+        response.set_cookie(name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app),
+                            domain=domain, path=path)